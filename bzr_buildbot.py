@@ -99,8 +99,13 @@ except ImportError:
     DEFINE_POLLER = False
 else:
     DEFINE_POLLER = True
+import random
+import threading
+import urlparse
+
 import bzrlib.branch
 import bzrlib.errors
+import bzrlib.revision
 import bzrlib.trace
 import twisted.cred.credentials
 import twisted.internet.base
@@ -110,6 +115,7 @@ import twisted.internet.selectreactor
 import twisted.internet.task
 import twisted.internet.threads
 import twisted.python.log
+import twisted.python.threadpool
 import twisted.spread.pb
 
 
@@ -159,9 +165,17 @@ def generate_change(branch,
     # name, email = bzrtools.config.parse_username(change['who'])
     change['comments'] = new_rev.message
     change['revision'] = new_revno
-    files = change['files'] = []
-    changes = repository.revision_tree(new_revid).changes_from(
-        repository.revision_tree(old_revid))
+    change['files'] = changed_files(repository.revision_tree(new_revid),
+                                    repository.revision_tree(old_revid))
+    return change
+
+def changed_files(new_tree, old_tree):
+    """Return the files changed between two trees, described as strings.
+
+    Each string is the path, the kind of file, and what happened to it, as
+    used in the "files" of a change."""
+    files = []
+    changes = new_tree.changes_from(old_tree)
     for (collection, name) in ((changes.added, 'ADDED'),
                                (changes.removed, 'REMOVED'),
                                (changes.modified, 'MODIFIED')):
@@ -175,7 +189,70 @@ def generate_change(branch,
         if text_modified or meta_modified:
             elements.append('MODIFIED')
         files.append(' '.join(elements))
-    return change
+    return files
+
+def generate_changes(branch, old_revno, new_revno=None,
+                     blame_merge_author=False):
+    """Return a list of changes for every revision after old_revno.
+
+    This gives the same dicts as generate_change, oldest first, but reads
+    the whole range at once: the revision ids come from one walk of the
+    branch's history, and the revisions and their trees are each fetched
+    from the repository in a single batch, all under one read lock."""
+    branch.lock_read()
+    try:
+        if new_revno is None:
+            new_revno = branch.revno()
+        if new_revno <= old_revno:
+            return []
+        repository = branch.repository
+        count = new_revno - old_revno
+
+        # Walk back from the tip to the last revision we've seen.
+        revids = []
+        for revid in repository.get_graph().iter_lefthand_ancestry(
+                branch.get_rev_id(new_revno)):
+            revids.append(revid)
+            if len(revids) > count:
+                break
+        revids.reverse()
+        if len(revids) == count:
+            # The range starts at the first revision.
+            revids.insert(0, bzrlib.revision.NULL_REVISION)
+
+        revisions = dict(zip(revids[1:],
+                             repository.get_revisions(revids[1:])))
+        tree_ids = [revid for revid in revids
+                    if revid != bzrlib.revision.NULL_REVISION]
+        trees = dict(zip(tree_ids, repository.revision_trees(tree_ids)))
+        if len(tree_ids) < len(revids):
+            trees[bzrlib.revision.NULL_REVISION] = \
+                repository.revision_tree(bzrlib.revision.NULL_REVISION)
+
+        # Merge authors for PQM-style commits, again fetched in one go.
+        merged = {}
+        if blame_merge_author:
+            parent_ids = [revisions[revid].parent_ids[-1]
+                          for revid in revids[1:]]
+            merged = dict(zip(revids[1:],
+                              repository.get_revisions(parent_ids)))
+
+        changes = []
+        for i in range(1, len(revids)):
+            revid = revids[i]
+            rev = revisions[revid]
+            if blame_merge_author:
+                author = merged[revid].get_apparent_authors()[0]
+            else:
+                author = rev.get_apparent_authors()[0]
+            changes.append({ 'author': author,
+                             'comments': rev.message,
+                             'revision': old_revno + i,
+                             'files': changed_files(trees[revid],
+                                                    trees[revids[i - 1]]) })
+        return changes
+    finally:
+        branch.unlock()
 
 #############################################################################
 # poller
@@ -188,13 +265,142 @@ if DEFINE_POLLER:
     SHORT = object()
 
 
+    class BzrPollerManager:
+
+        """Run the polls for many BzrPollers.
+
+        Pollers given a manager don't poll on their own timers.  Instead,
+        the manager spreads their first polls randomly across the poll
+        interval, and adds jitter to every poll after that, so that they
+        don't all hit the server at once.  The bzr work runs in the
+        manager's own pool of at most max_workers threads, and the
+        transports (and so the connections) opened by a poll are kept,
+        per host, for later polls of any branch on that host.
+
+        Branches which rarely change are polled less often: after
+        idle_polls polls in a row with nothing new, a poller's interval
+        is doubled, up to max_backoff times its poll_interval.  Any new
+        revision puts it back to the poll_interval."""
+
+        def __init__(self, max_workers=4, jitter=0.1, idle_polls=3,
+                     max_backoff=8):
+            self.max_workers = max_workers
+            self.jitter = jitter
+            self.idle_polls = idle_polls
+            self.max_backoff = max_backoff
+            self.pool = None
+            self.shutdown_trigger = None
+            self.pollers = {}
+            self.transports = {}
+            self.transports_lock = threading.Lock()
+
+        def _start_pool(self):
+            if self.pool is None:
+                self.pool = twisted.python.threadpool.ThreadPool(
+                    0, self.max_workers, "BzrPollerManager")
+                self.pool.start()
+            # The pool comes and goes with its pollers, but one trigger
+            # will stop whichever pool is running at shutdown.
+            if self.shutdown_trigger is None:
+                self.shutdown_trigger = \
+                    twisted.internet.reactor.addSystemEventTrigger(
+                        'during', 'shutdown', self._stop_pool)
+
+        def _stop_pool(self):
+            if self.pool is not None:
+                self.pool.stop()
+                self.pool = None
+
+        def register(self, poller):
+            self._start_pool()
+            state = { 'idle': 0, 'backoff': 1, 'call': None }
+            self.pollers[poller] = state
+            state['call'] = twisted.internet.reactor.callLater(
+                random.uniform(0, poller.poll_interval), self._poll, poller)
+
+        def unregister(self, poller):
+            state = self.pollers.pop(poller, None)
+            if state is not None and state['call'] is not None and \
+                    state['call'].active():
+                state['call'].cancel()
+            if not self.pollers:
+                self._stop_pool()
+
+        def _poll(self, poller):
+            # A failed poll counts as finding nothing; either way, the
+            # next poll must be scheduled.
+            d = twisted.internet.defer.maybeDeferred(poller.poll)
+            d.addErrback(self._poll_failed, poller)
+            d.addCallback(self._polled, poller)
+            d.addErrback(twisted.python.log.err)
+
+        def _poll_failed(self, failure, poller):
+            twisted.python.log.err(failure, "while polling %s" % poller.url)
+            return False
+
+        def _polled(self, found, poller):
+            state = self.pollers.get(poller)
+            if state is None:
+                return
+            if found:
+                state['idle'] = 0
+                state['backoff'] = 1
+            else:
+                state['idle'] += 1
+                if state['idle'] >= self.idle_polls:
+                    state['idle'] = 0
+                    state['backoff'] = min(state['backoff'] * 2,
+                                           self.max_backoff)
+            delay = poller.poll_interval * state['backoff'] * \
+                random.uniform(1 - self.jitter, 1 + self.jitter)
+            state['call'] = twisted.internet.reactor.callLater(
+                delay, self._poll, poller)
+
+        def deferToThread(self, f, *args, **kwargs):
+            self._start_pool()
+            return twisted.internet.threads.deferToThreadPool(
+                twisted.internet.reactor, self.pool, f, *args, **kwargs)
+
+        # A poll takes a list of transports for its branch's host, and
+        # gives it back when it's done; bzrlib reuses any of them which
+        # fit the URL it opens.  No two polls share a list at once, as
+        # transports aren't safe to use from two threads.
+
+        def checkout_transports(self, url):
+            host = urlparse.urlsplit(url)[:2]
+            self.transports_lock.acquire()
+            try:
+                free = self.transports.setdefault(host, [])
+                if free:
+                    return free.pop()
+                return []
+            finally:
+                self.transports_lock.release()
+
+        def checkin_transports(self, url, transports):
+            host = urlparse.urlsplit(url)[:2]
+            self.transports_lock.acquire()
+            try:
+                self.transports.setdefault(host, []).append(transports)
+            finally:
+                self.transports_lock.release()
+
+
     class BzrPoller(buildbot.changes.base.ChangeSource,
                     buildbot.util.ComparableMixin):
 
+        """Poll a bzr branch for new revisions.
+
+        The last revision seen is kept in the master's database, where
+        there is one, so commits made while the master is down are
+        reported when it comes back, rather than lost.  All of the
+        revisions found by a poll are read from the branch in one go
+        (see generate_changes)."""
+
         compare_attrs = ['url']
 
         def __init__(self, url, poll_interval=10*60, blame_merge_author=False,
-                     branch_name=None, category=None):
+                     branch_name=None, category=None, manager=None):
             # poll_interval is in seconds, so default poll_interval is 10
             # minutes.
             # bzr+ssh://bazaar.launchpad.net/~launchpad-pqm/launchpad/devel/
@@ -207,6 +413,8 @@ if DEFINE_POLLER:
             self.blame_merge_author = blame_merge_author
             self.branch_name = branch_name
             self.category = category
+            self.manager = manager
+            self.state_objectid = None
 
         def startService(self):
             twisted.python.log.msg("BzrPoller(%s) starting" % self.url)
@@ -226,68 +434,128 @@ if DEFINE_POLLER:
             else:
                 ourbranch = self.branch_name
             self.last_revision = None
+            self.state_loaded = False
             self.polling = False
-            twisted.internet.reactor.callWhenRunning(
-                self.loop.start, self.poll_interval)
+            if self.manager is not None:
+                twisted.internet.reactor.callWhenRunning(
+                    self.manager.register, self)
+            else:
+                twisted.internet.reactor.callWhenRunning(
+                    self.loop.start, self.poll_interval)
 
         def stopService(self):
             twisted.python.log.msg("BzrPoller(%s) shutting down" % self.url)
-            self.loop.stop()
+            if self.manager is not None:
+                self.manager.unregister(self)
+            elif self.loop.running:
+                self.loop.stop()
             return buildbot.changes.base.ChangeSource.stopService(self)
 
         def describe(self):
             return "BzrPoller watching %s" % self.url
 
+        def _get_state_db(self):
+            db = getattr(self.master, 'db', None)
+            return getattr(db, 'state', None)
+
+        @twisted.internet.defer.inlineCallbacks
+        def loadLastRevision(self):
+            """Get the last revision seen before the master was restarted.
+
+            Masters without a state database (before buildbot 0.8.4) start
+            from the branch tip, as they always have."""
+            state = self._get_state_db()
+            if state is None:
+                twisted.internet.defer.returnValue(None)
+            if self.state_objectid is None:
+                self.state_objectid = yield state.getObjectId(
+                    self.url, self.__class__.__name__)
+            last_revision = yield state.getState(
+                self.state_objectid, 'last_revision', None)
+            twisted.internet.defer.returnValue(last_revision)
+
+        def saveLastRevision(self):
+            state = self._get_state_db()
+            if state is None or self.state_objectid is None:
+                return twisted.internet.defer.succeed(None)
+            return state.setState(self.state_objectid, 'last_revision',
+                                  self.last_revision)
+
         @twisted.internet.defer.inlineCallbacks
         def poll(self):
             if self.polling: # this is called in a loop, and the loop might
                 # conceivably overlap.
-                return
+                twisted.internet.defer.returnValue(False)
             self.polling = True
+            found = False
             try:
+                if not self.state_loaded:
+                    self.last_revision = yield self.loadLastRevision()
+                    self.state_loaded = True
                 # On a big tree, even individual elements of the bzr commands
                 # can take awhile. So we just push the bzr work off to a
                 # thread.
+                if self.manager is not None:
+                    deferToThread = self.manager.deferToThread
+                else:
+                    deferToThread = twisted.internet.threads.deferToThread
                 try:
-                    changes = yield twisted.internet.threads.deferToThread(
-                        self.getRawChanges)
+                    (tip, changes) = yield deferToThread(
+                        self.getRawChanges, self.last_revision)
                 except (SystemExit, KeyboardInterrupt):
                     raise
                 except:
                     # we'll try again next poll.  Meanwhile, let's report.
                     twisted.python.log.err()
                 else:
+                    found = bool(changes)
                     for change in changes:
                         yield self.addChange(change)
                         self.last_revision = change['revision']
+                        yield self.saveLastRevision()
+                    if self.last_revision != tip:
+                        # First poll, or the branch went backwards
+                        # (uncommit); start again from the tip.
+                        self.last_revision = tip
+                        yield self.saveLastRevision()
             finally:
                 self.polling = False
+            twisted.internet.defer.returnValue(found)
+
+        def getRawChanges(self, last_revision):
+            """Return the branch tip and the changes since last_revision.
+
+            With no last revision, there are no changes; we just start
+            watching from the tip."""
+            if self.manager is not None:
+                transports = self.manager.checkout_transports(self.url)
+            else:
+                transports = None
+            try:
+                return self._getRawChanges(last_revision, transports)
+            finally:
+                if transports is not None:
+                    self.manager.checkin_transports(self.url, transports)
 
-        def getRawChanges(self):
-            branch = bzrlib.branch.Branch.open_containing(self.url)[0]
+        def _getRawChanges(self, last_revision, transports):
+            branch = bzrlib.branch.Branch.open_containing(
+                self.url, possible_transports=transports)[0]
             if self.branch_name is FULL:
                 branch_name = self.url
             elif self.branch_name is SHORT:
                 branch_name = branch.nick
             else: # presumably a string or maybe None
                 branch_name = self.branch_name
-            changes = []
-            change = generate_change(
-                branch, blame_merge_author=self.blame_merge_author)
-            if self.last_revision is None:
-                self.last_revision = change['revision']
-            elif change['revision'] > self.last_revision:
+            tip = branch.revno()
+            if last_revision is None or tip <= last_revision:
+                return (tip, [])
+            changes = generate_changes(
+                branch, last_revision, tip,
+                blame_merge_author=self.blame_merge_author)
+            for change in changes:
                 change['branch'] = branch_name
                 change['category'] = self.category
-                changes.append(change)
-                while self.last_revision + 1 < change['revision']:
-                    change = generate_change(
-                        branch, new_revno=change['revision']-1,
-                        blame_merge_author=self.blame_merge_author)
-                    change['branch'] = branch_name
-                    changes.append(change)
-            changes.reverse()
-            return changes
+            return (tip, changes)
 
         def addChange(self, change):
             return self.master.addChange(**change)
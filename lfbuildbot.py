@@ -9,19 +9,40 @@
 
 import os
 import re
+import time
+import json
+from collections import deque
+from email.parser import HeaderParser
 
 from twisted.python import log
+from twisted.python.filepath import FilePath
 from twisted.application import internet
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
+from twisted.web import resource, server, http
+
+# inotify support is Linux-only and new in Twisted 10; without it, we
+# just fall back to polling the job directory.
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
 
 from buildbot.process.properties import Properties
+from buildbot.process.buildstep import LogLineObserver
 from buildbot.steps.shell import ShellCommand
 from buildbot.steps.master import MasterShellCommand
+from buildbot import util
+from buildbot.changes.filter import ChangeFilter
 from buildbot.schedulers.base import BaseScheduler
+from buildbot.schedulers.basic import AnyBranchScheduler
 from buildbot.schedulers.triggerable import Triggerable
 from buildbot.sourcestamp import SourceStamp
+from buildbot.status.base import StatusReceiver, StatusReceiverMultiService
+from buildbot.status.results import SUCCESS, WARNINGS, SKIPPED, RETRY
 from buildbot.changes.mail import BzrLaunchpadEmailMaildirSource
 
+import lsbmetrics
+
 # Helper function.  This takes a branch as passed into buildbot, and
 # pulls out just the LSB version part.  If it can't figure out the
 # LSB version, it creates a normalized branch name based off the
@@ -39,31 +60,39 @@ def extract_branch_name(branch):
     return branch_name
 
 # Job file parser for MultiScheduler.  It turns a job file into a number
-# of BuildRequest objects.
+# of BuildRequest objects.  If it's given the build dependency graph,
+# it also works out which builders in the job have to wait for other
+# builders in the same job to finish first.
 
 class JobParseError(Exception):
     pass
 
 class MultiJobFile:
     def __init__(self, path, repos, archs, indep_prj, indep_arch,
-                 devchk_builders, prop):
+                 devchk_builders, prop, dag=None):
         self.tag = None
         self.projects = []
         self.branch_name = None
         self.build_type = "normal"
-        self.properties = prop
+        self.properties = Properties()
+        self.properties.updateFromProperties(prop)
         self.path = path
         self.repos = repos
         self.archs = archs
         self.indep_prj = indep_prj
         self.indep_arch = indep_arch
         self.devchk_builders = devchk_builders
+        self.dag = dag
 
         try:
             self.f = open(self.path)
         except:
             raise JobParseError("could not open job file " + self.path)
 
+        # Remember when the job was submitted, so we can report how long
+        # it took us to notice it.
+        self.mtime = os.fstat(self.f.fileno()).st_mtime
+
         try:
             self.parse()
         finally:
@@ -84,11 +113,8 @@ class MultiJobFile:
         else:
             return project_name
 
-    def __iter__(self):
-        if self.tag:
-            revision = "tag:" + self.tag
-        else:
-            revision = "-1"
+    def _builders(self):
+        "Generate (repository, project, arch or slave id) for the job."
 
         for prj in self.projects:
             if prj in self.indep_prj:
@@ -105,19 +131,85 @@ class MultiJobFile:
                 for build in ["build-sdk", "devchk"]:
                     repo = self.get_repo(build)
                     for builder in self.devchk_builders:
-                        builderNames = ["%s-%s" % (build, builder)]
-                        branch = "lsb/%s/%s" % (self.branch_name, repo)
-                        ss = SourceStamp(branch, revision, None, None)
-                        yield (ss, builderNames, self.properties,
-                               "MultiScheduler job")
+                        yield (repo, build, builder)
             else:
                 repo = self.get_repo(prj)
                 for arch in archs:
-                    builderNames = ["%s-%s" % (prj, arch)]
-                    branch = "lsb/%s/%s" % (self.branch_name, repo)
-                    ss = SourceStamp(branch, revision, None, None)
-                    yield (ss, builderNames, self.properties,
-                           "MultiScheduler job")
+                    yield (repo, prj, arch)
+
+    def _wait_for(self, prj, suffix, job_builders):
+        "Find the builders in this job that must finish before this one."
+
+        if self.dag is None:
+            return ()
+
+        wait_for = []
+        for dep in self.dag.ancestors(prj):
+            if (dep, suffix) in job_builders:
+                wait_for.append("%s-%s" % (dep, suffix))
+        wait_for.sort()
+        return tuple(wait_for)
+
+    def __iter__(self):
+        if self.tag:
+            revision = "tag:" + self.tag
+        else:
+            revision = "-1"
+
+        # Share one source stamp between all the builders that build
+        # from the same branch and revision (every arch of a project,
+        # and projects built from the same repository), and start them
+        # all in one buildset.  A big job then costs a handful of
+        # database round trips, rather than a couple per builder.
+        # Builders that have to wait for others in the job get buildsets
+        # of their own, grouped by what they're waiting for.
+        builders = list(self._builders())
+        job_builders = set([(prj, suffix) for (repo, prj, suffix) 
+                            in builders])
+
+        groups = {}
+        group_order = []
+        for (repo, prj, suffix) in builders:
+            builderName = "%s-%s" % (prj, suffix)
+            branch = "lsb/%s/%s" % (self.branch_name, repo)
+            key = (branch, self._wait_for(prj, suffix, job_builders))
+            if key not in groups:
+                groups[key] = []
+                group_order.append(key)
+            if builderName not in groups[key]:
+                groups[key].append(builderName)
+
+        for key in group_order:
+            (branch, wait_for) = key
+            ss = SourceStamp(branch, revision, None, None)
+            yield (ss, groups[key], self.properties, "MultiScheduler job",
+                   wait_for)
+
+    def estimate_duration(self, estimator):
+        """Roughly estimate how long the job will take to build.
+
+        Each architecture's builds are assumed to run one at a time,
+        and builders that wait for others in the job to start when the
+        last of those is done."""
+
+        builders = [(prj, suffix) for (repo, prj, suffix) in self._builders()]
+        if self.dag is not None:
+            builders.sort(key=lambda b: self.dag.builder_rank("%s-%s" % b))
+
+        finish = {}
+        serial = {}
+        for (prj, suffix) in builders:
+            if (prj, suffix) in finish:
+                continue
+            duration = estimator.expected("%s-%s" % (prj, suffix),
+                                          self.build_type)
+            start = 0
+            if self.dag is not None:
+                for dep in self.dag.ancestors(prj):
+                    start = max(start, finish.get((dep, suffix), 0))
+            finish[(prj, suffix)] = start + duration
+            serial[suffix] = serial.get(suffix, 0) + duration
+        return max(finish.values() + serial.values() or [0])
 
     def parse(self):
         for line in self.f:
@@ -154,13 +246,62 @@ class MultiJobFile:
 
 # Scheduler which can start a number of builds at once.  These are
 # grouped by project; they are started across all supported architectures.
+#
+# The job directory is a maildir-style spool.  Writers create job files
+# in "tmp", and rename them into "new" when they're complete.  We claim
+# a job by renaming it into "cur", and only remove it from there once
+# every buildset it asks for has been created.  Job files which can't be
+# parsed are moved to "failed".  Anything left in "cur" that we aren't
+# working on (because the master died, or the database complained) is
+# retried, skipping the buildsets it already created; each buildset is
+# tagged with the job name and its index in the job for this purpose.
+# For compatibility, job files dropped directly into the job directory
+# are still accepted once they've been left alone for a few seconds.
+#
+# Given the build dependency graph, builders in a job that depend on
+# other builders in the same job (on the same arch) are held back until
+# those finish, so they don't build against stale saved results.  Each
+# held group is released as soon as its own producers have built
+# successfully; there's no waiting for the rest of the job.  If one of
+# its producers fails (or is cancelled), or the group has been held for
+# longer than hold_timeout, the group is dropped instead, and its
+# builders don't build for this job.  A producer's build normally says
+# which job it's for, but one whose request was merged into another
+# job's build won't; so when a job's buildset completes, we also look
+# up how each of its requests went.
+#
+# If creating any of a job's buildsets fails, we let the rest of them
+# (held ones included) settle before leaving the job in "cur" to be
+# retried, so the retry can't miss buildsets that were still being
+# created.  A retry holds its groups as before; we remember which of
+# the job's producers have finished, so a group whose producers are
+# already done is released (or dropped) straight away.  Jobs found in
+# "cur" when the scheduler starts are different: we don't know what
+# already ran for them, so nothing is held.  Given a duration estimator,
+# we log how long each new job should take.
+#
+# The spool is watched with inotify where available, so new job files
+# are picked up as soon as they are renamed into place.  We still rescan
+# every so often, in case we miss an event (or can't get events at all,
+# in which case we rescan much more often).
+
+spool_areas = ("tmp", "new", "cur", "failed")
+
+class HeldBuildsDropped(Exception):
+    pass
+
+class HoldInterrupted(Exception):
+    pass
 
 class MultiScheduler(BaseScheduler):
     compare_attrs = ('name', 'builderNames', 'jobdir', 'repos', 'archs', 
-                     'indep_prj', 'properties')
+                     'indep_prj', 'properties', 'poll_interval',
+                     'fallback_interval', 'dag', 'estimator')
 
     def __init__(self, name, builderNames, jobdir, repos, archs, indep_prj, 
-                 indep_arch, devchk_builders, prop_dict={}):
+                 indep_arch, devchk_builders, prop_dict={}, poll_interval=10,
+                 fallback_interval=300, legacy_settle_time=5, dag=None,
+                 estimator=None, hold_timeout=24 * 60 * 60):
         BaseScheduler.__init__(self, name, builderNames, prop_dict)
         self.builderNames = builderNames
         self.jobdir = jobdir
@@ -169,7 +310,36 @@ class MultiScheduler(BaseScheduler):
         self.indep_prj = indep_prj
         self.indep_arch = indep_arch
         self.devchk_builders = devchk_builders
+        self.poll_interval = poll_interval
+        self.fallback_interval = fallback_interval
+        self.legacy_settle_time = legacy_settle_time
+        self.dag = dag
+        self.estimator = estimator
+        self.hold_timeout = hold_timeout
         self.poller = None
+        self.notifier = None
+        self.in_flight = set()
+
+        # Jobs which failed while we were running, to be retried.
+        self.retry_jobs = set()
+
+        # How each finished producer did, by job name and builder, for
+        # jobs we're submitting or retrying.
+        self.finished_builders = {}
+
+        # Held buildsets, by job name: lists of [builders to wait for,
+        # deferred to fire once they're done, timeout call].
+        self.held = {}
+        self.build_watcher = BuildFinishedWatcher(self._build_finished)
+
+        # The job each buildset we created belongs to, until it completes.
+        self.job_buildsets = {}
+        self.buildset_subscription = None
+
+        # Submission lag statistics, in seconds.
+        self.lag_count = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
 
     def listBuilderNames(self):
         return self.builderNames
@@ -179,40 +349,784 @@ class MultiScheduler(BaseScheduler):
 
     def startService(self):
         BaseScheduler.startService(self)
-        self.poller = reactor.callLater(10, self.poll)
+        for area in spool_areas:
+            area_path = os.path.join(self.jobdir, area)
+            if not os.path.isdir(area_path):
+                os.makedirs(area_path)
+        self.notifier = self._start_notifier()
+        self.master.status.subscribe(self.build_watcher)
+        self.buildset_subscription = \
+            self.master.subscribeToBuildsetCompletions(
+                self._buildset_complete)
+        self.poller = reactor.callLater(0, self.poll)
 
     def stopService(self):
         BaseScheduler.stopService(self)
-        self.poller.cancel()
+        self.master.status.unsubscribe(self.build_watcher)
+        if self.buildset_subscription is not None:
+            self.buildset_subscription.unsubscribe()
+            self.buildset_subscription = None
+        self.job_buildsets = {}
+        for name in self.held.keys():
+            self._fail_held(name, HoldInterrupted("%s stopped" % self.name))
+        if self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+        if self.poller is not None and self.poller.active():
+            self.poller.cancel()
         self.poller = None
 
+    def _start_notifier(self):
+        if inotify is None:
+            log.msg("%s: no inotify support, polling %s every %d seconds"
+                    % (self.name, self.jobdir, self.poll_interval))
+            return None
+
+        try:
+            notifier = inotify.INotify()
+            notifier.startReading()
+            for watch_dir in [self.jobdir, os.path.join(self.jobdir, "new")]:
+                notifier.watch(FilePath(watch_dir),
+                               mask=inotify.IN_CLOSE_WRITE | 
+                                    inotify.IN_MOVED_TO,
+                               callbacks=[self._jobdir_changed])
+        except Exception, e:
+            log.msg("%s: could not watch %s (%s), polling every %d seconds"
+                    % (self.name, self.jobdir, str(e), self.poll_interval))
+            return None
+
+        return notifier
+
+    def _jobdir_changed(self, ignored, filepath, mask):
+        # Pull the next scan forward; a burst of events collapses into
+        # a single scan this way.
+        if self.poller is not None and self.poller.active():
+            self.poller.reset(0)
+
+    def _next_poll_interval(self):
+        if self.notifier is not None:
+            return self.fallback_interval
+        else:
+            return self.poll_interval
+
     def poll(self):
-        for f in os.listdir(self.jobdir):
+        next_poll = self._next_poll_interval()
+        cur_path = os.path.join(self.jobdir, "cur")
+        new_path = os.path.join(self.jobdir, "new")
+
+        for f in sorted(os.listdir(cur_path)):
+            if f in self.in_flight:
+                continue
+            if f in self.retry_jobs:
+                self.process_job(f, retrying=True)
+            else:
+                self.process_job(f, recovering=True)
+
+        for f in sorted(os.listdir(new_path)):
+            claimed = self._claim_job(os.path.join(new_path, f), f)
+            if claimed:
+                self.process_job(claimed)
+
+        for f in sorted(os.listdir(self.jobdir)):
             f_full = os.path.join(self.jobdir, f)
+            if f in spool_areas or not os.path.isfile(f_full):
+                continue
+
+            # We can't tell whether the writer is done with these, so
+            # wait until the file has been quiet for a little while.
+            age = time.time() - os.path.getmtime(f_full)
+            if age < self.legacy_settle_time:
+                next_poll = min(next_poll, self.legacy_settle_time - age)
+                continue
+
+            claimed = self._claim_job(f_full, f)
+            if claimed:
+                self.process_job(claimed)
+
+        self.poller = reactor.callLater(next_poll, self.poll)
+
+    def _claim_job(self, path, name):
+        "Move a job file into cur, giving it a unique name."
+
+        now = time.time()
+        claimed = "%d.%06d.%s" % (int(now), int((now % 1) * 1000000), name)
+        try:
+            os.rename(path, os.path.join(self.jobdir, "cur", claimed))
+        except OSError, e:
+            log.msg("could not claim job file %s: %s" % (name, str(e)))
+            return None
+        return claimed
+
+    def process_job(self, name, recovering=False, retrying=False):
+        f_full = os.path.join(self.jobdir, "cur", name)
+        try:
+            jobfile = MultiJobFile(f_full, self.repos, self.archs,
+                                   self.indep_prj, self.indep_arch, 
+                                   self.devchk_builders, self.properties,
+                                   dag=self.dag)
+        except JobParseError, e:
+            log.msg("bad job file %s: %s" % (name, str(e)))
             try:
-                try:
-                    jobfile = MultiJobFile(f_full, self.repos, self.archs,
-                                           self.indep_prj, self.indep_arch, 
-                                           self.devchk_builders,
-                                           self.properties)
-                    for (ss, builderNames, properties, reason) in jobfile:
-                        d = ss.getSourceStampSetId(self.master)
-                        d.addCallback(self.buildset_cb,
-                                      builderNames=builderNames,
-                                      properties=properties,
-                                      reason=reason)
-                finally:
-                    os.unlink(f_full)
-            except JobParseError, e:
-                log.msg("bad job file %s: %s" % (f, str(e)))
+                os.rename(f_full, os.path.join(self.jobdir, "failed", name))
+            except OSError:
+                log.err()
+            return
+
+        jobfile.properties.setProperty("multi_job", name, "MultiScheduler")
+        if self.estimator is not None and not (recovering or retrying):
+            log.msg("%s: job %s should take about %d minutes"
+                    % (self.name, name,
+                       jobfile.estimate_duration(self.estimator) / 60))
+
+        self.in_flight.add(name)
+        self.retry_jobs.discard(name)
+        if recovering or retrying:
+            d = self._get_submitted_ids(name)
+        else:
+            d = defer.succeed(set())
+        d.addCallback(self._submit_job, jobfile, name, recovering)
+        d.addCallback(self._check_submitted, name)
+        d.addCallbacks(self._job_done, self._job_failed,
+                       callbackArgs=(name,), errbackArgs=(name,))
+        return d
+
+    def _get_submitted_ids(self, name):
+        "Find the buildsets a job we're retrying already created."
+
+        def filter_ids(bsdicts):
+            prefix = name + ":"
+            return set([bs['external_idstring'] for bs in bsdicts
+                        if bs['external_idstring'] and 
+                           bs['external_idstring'].startswith(prefix)])
+
+        d = self.master.db.buildsets.getBuildsets()
+        d.addCallback(filter_ids)
+        return d
+
+    def _submit_job(self, submitted_ids, jobfile, name, recovering=False):
+        dl = []
+        index = 0
+        for (ss, builderNames, properties, reason, wait_for) in jobfile:
+            idstring = "%s:%d" % (name, index)
+            index += 1
+            if idstring in submitted_ids:
                 continue
 
-        self.poller = reactor.callLater(10, self.poll)
+            held = wait_for and not recovering
+            if held:
+                d = self._hold(name, wait_for)
+                d.addCallback(lambda _, ss=ss: 
+                                  ss.getSourceStampSetId(self.master))
+            else:
+                d = ss.getSourceStampSetId(self.master)
+            d.addCallback(self.buildset_cb,
+                          builderNames=builderNames,
+                          properties=properties,
+                          reason=reason,
+                          external_idstring=idstring,
+                          jobname=name,
+                          submitted=jobfile.mtime)
+            if held:
+                d.addErrback(self._held_dropped, name, builderNames)
+            dl.append(d)
+
+        return defer.DeferredList(dl, consumeErrors=True)
+
+    def _check_submitted(self, results, name):
+        "Pass on the first failure, once every buildset has settled."
+
+        failures = [result for (success, result) in results if not success]
+        for failure in failures[1:]:
+            log.err(failure, "while submitting job %s" % name)
+        if failures:
+            return failures[0]
+        return results
+
+    def _hold(self, name, wait_for):
+        wait_for = set(wait_for)
+        finished = self.finished_builders.get(name, {})
+        for builderName in sorted(wait_for):
+            if builderName not in finished:
+                continue
+            if finished[builderName] not in (SUCCESS, WARNINGS):
+                return defer.fail(HeldBuildsDropped(
+                        "%s did not build" % builderName))
+            wait_for.discard(builderName)
+        if not wait_for:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        hold = [wait_for, d, None]
+        hold[2] = reactor.callLater(self.hold_timeout, self._hold_timed_out,
+                                    name, hold)
+        self.held.setdefault(name, []).append(hold)
+        return d
+
+    def _unhold(self, name, holds):
+        remaining = [h for h in self.held.get(name, []) if h not in holds]
+        if remaining:
+            self.held[name] = remaining
+        elif name in self.held:
+            del self.held[name]
+        for (wait_for, d, timer) in holds:
+            if timer.active():
+                timer.cancel()
+
+    def _hold_timed_out(self, name, hold):
+        self._unhold(name, [hold])
+        hold[1].errback(HeldBuildsDropped(
+                "still waiting for %s after %d seconds"
+                % (", ".join(sorted(hold[0])), self.hold_timeout)))
+
+    def _fail_held(self, name, exception):
+        holds = self.held.pop(name, [])
+        self._unhold(name, holds)
+        for (wait_for, d, timer) in holds:
+            d.errback(exception)
+
+    def _held_dropped(self, failure, name, builderNames):
+        failure.trap(HeldBuildsDropped)
+        log.msg("%s: not building %s for job %s: %s"
+                % (self.name, ", ".join(builderNames), name,
+                   failure.getErrorMessage()))
+
+    def _builder_done(self, name, builderName, results):
+        "Release or drop the held groups waiting on a builder."
+
+        # Builds which are retried will finish again.
+        if results == RETRY:
+            return
+        self.finished_builders.setdefault(name, {})[builderName] = results
+
+        released = []
+        failed = []
+        for hold in self.held.get(name, []):
+            wait_for = hold[0]
+            if builderName not in wait_for:
+                continue
+            if results in (SUCCESS, WARNINGS):
+                wait_for.discard(builderName)
+                if not wait_for:
+                    released.append(hold)
+            else:
+                failed.append(hold)
+
+        self._unhold(name, released + failed)
+        for (wait_for, d, timer) in released:
+            log.msg("%s: %s finished, releasing held builds for job %s"
+                    % (self.name, builderName, name))
+            d.callback(None)
+        for (wait_for, d, timer) in failed:
+            d.errback(HeldBuildsDropped("%s did not build" % builderName))
+
+    def _build_finished(self, builderName, build, results):
+        name = build.getProperties().getProperty("multi_job", None)
+        if self._job_active(name):
+            self._builder_done(name, builderName, results)
+
+    def _buildset_complete(self, bsid, result):
+        name = self.job_buildsets.pop(bsid, None)
+        if not self._job_active(name):
+            return
+
+        def check_requests(brdicts):
+            for brdict in brdicts:
+                if brdict["complete"]:
+                    self._builder_done(name, brdict["buildername"],
+                                       brdict["results"])
+
+        d = self.master.db.buildrequests.getBuildRequests(bsid=bsid)
+        d.addCallback(check_requests)
+        d.addErrback(log.err, "while checking buildset %d for job %s"
+                     % (bsid, name))
+
+    def _job_active(self, name):
+        return name in self.in_flight or name in self.retry_jobs
+
+    def _job_done(self, result, name):
+        self.in_flight.discard(name)
+        self.finished_builders.pop(name, None)
+        try:
+            os.unlink(os.path.join(self.jobdir, "cur", name))
+        except OSError:
+            log.err()
+
+    def _job_failed(self, failure, name):
+        # Leave the job in cur; the next scan will pick up where we left off.
+        self.in_flight.discard(name)
+        self.retry_jobs.add(name)
+        log.msg("could not submit job %s; will retry" % name)
+        log.err(failure)
+
+    def buildset_cb(self, setid, builderNames, properties, reason,
+                    external_idstring=None, jobname=None, submitted=None):
+        d = self.addBuildsetForSourceStamp(setid=setid, reason=reason,
+                                           external_idstring=external_idstring,
+                                           builderNames=builderNames,
+                                           properties=properties)
+        if submitted is not None:
+            d.addCallback(self._record_lag, jobname, submitted)
+        if jobname is not None:
+            d.addCallback(self._track_buildset, jobname)
+        return d
+
+    def _track_buildset(self, result, jobname):
+        (bsid, brids) = result
+        self.job_buildsets[bsid] = jobname
+        return result
+
+    def _record_lag(self, result, jobname, submitted):
+        lag = max(time.time() - submitted, 0.0)
+        self.lag_count += 1
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+        log.msg("%s: job %s lag %.3fs (mean %.3fs, max %.3fs over %d)"
+                % (self.name, jobname, lag, self.lag_total / self.lag_count,
+                   self.lag_max, self.lag_count))
+        return result
+
+# Scheduler for all of the version control triggered builds.  One
+# Scheduler per project, architecture and branch meant hundreds of
+# schedulers, each checking every change and running its own stable
+# timer.  This one is given an index mapping each branch to the builders
+# its changes start (see LSBModel.branch_index), so each change costs a
+# dict lookup, and there's one tree-stable timer per branch.  When the
+# timer fires, the builders for that branch get one buildset for all its
+# changes.  Builders whose project only uses the changed branch as an
+# extra repository get a build of the latest of their own branch
+# instead.  Branches can have their own stable time in branchTimers.
+
+class BranchIndexFilter(ChangeFilter):
+    compare_attrs = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def filter_change(self, change):
+        return change.branch in self.index
+
+    def __repr__(self):
+        return "<%s on %d branches>" % (self.__class__.__name__,
+                                        len(self.index))
+
+class BranchIndexScheduler(AnyBranchScheduler):
+    compare_attrs = AnyBranchScheduler.compare_attrs + ('branchTimers',)
+
+    def __init__(self, name, branchIndex, treeStableTimer, branchTimers={},
+                 **kwargs):
+        self.branchIndex = branchIndex
+        self.branchTimers = branchTimers
+        builderNames = set()
+        for targets in branchIndex.values():
+            for builders in targets.values():
+                builderNames.update(builders)
+        AnyBranchScheduler.__init__(self, name=name,
+                                    treeStableTimer=treeStableTimer,
+                                    builderNames=sorted(builderNames),
+                                    **kwargs)
+
+    def getChangeFilter(self, branch, branches, change_filter, categories):
+        return BranchIndexFilter(self.branchIndex)
+
+    def getTimerNameForChange(self, change):
+        return change.branch
+
+    def getChangeClassificationsForTimer(self, objectid, timer_name):
+        return self.master.db.schedulers.getChangeClassifications(
+            objectid, branch=timer_name)
+
+    @util.deferredLocked('_stable_timers_lock')
+    def gotChange(self, change, important):
+        branch = change.branch
+        d = self.master.db.schedulers.classifyChanges(
+            self.objectid, { change.number: important })
+
+        def fix_timer(_):
+            if not important and not self._stable_timers[branch]:
+                return
+            if self._stable_timers[branch]:
+                self._stable_timers[branch].cancel()
+
+            def fire_timer():
+                d = self.stableTimerFired(branch)
+                d.addErrback(log.err, "while firing stable timer")
+            self._stable_timers[branch] = self._reactor.callLater(
+                self.branchTimers.get(branch, self.treeStableTimer),
+                fire_timer)
+        d.addCallback(fix_timer)
+        return d
+
+    @util.deferredLocked('_stable_timers_lock')
+    @defer.inlineCallbacks
+    def stableTimerFired(self, branch):
+        # The service may have been stopped in the meantime.
+        if not self._stable_timers[branch]:
+            return
+        del self._stable_timers[branch]
+
+        classifications = \
+            yield self.getChangeClassificationsForTimer(self.objectid, branch)
+        if not classifications:
+            return
+
+        changeids = sorted(classifications.keys())
+        targets = self.branchIndex.get(branch, {})
+        for target in sorted(targets.keys()):
+            if target == branch:
+                yield self.addBuildsetForChanges(
+                    reason="scheduler", changeids=changeids,
+                    builderNames=targets[target])
+            else:
+                yield self.addBuildsetForLatest(
+                    reason="scheduler: %s changed" % branch, branch=target,
+                    builderNames=targets[target])
+
+        yield self.master.db.schedulers.flushChangeClassifications(
+            self.objectid, less_than=changeids[-1] + 1)
+
+# Scheduler which rebuilds the consumers of a project's saved results
+# when the project builds successfully, so breakage in something like
+# tet-harness shows up in the builds which use it, without waiting for
+# the weekly job.  It's given an index mapping each producer builder and
+# branch to the consumers to rebuild (see LSBModel.consumer_index); a
+# rebuild is of the latest on the consumer's branch, and only on the
+# producer's architecture.  Builds started by MultiScheduler jobs are
+# left alone, because the job already holds back and then runs the
+# consumers it wants, and so are builds which reused their cached
+# results (see LSBBuildCache), as those didn't change anything.  Rebuilt
+# consumers can trigger their own consumers in turn; the dependency
+# graph has no cycles, so this always stops.
+
+class ConsumerScheduler(BaseScheduler):
+    compare_attrs = ('name', 'builderNames', 'properties', 'consumerIndex')
+
+    def __init__(self, name, consumerIndex, properties={}):
+        builderNames = set()
+        for targets in consumerIndex.values():
+            for builders in targets.values():
+                builderNames.update(builders)
+        BaseScheduler.__init__(self, name, sorted(builderNames), properties)
+        self.consumerIndex = consumerIndex
+        self.build_watcher = BuildFinishedWatcher(self._build_finished)
+
+    def startService(self):
+        BaseScheduler.startService(self)
+        self.master.status.subscribe(self.build_watcher)
+
+    def stopService(self):
+        self.master.status.unsubscribe(self.build_watcher)
+        return BaseScheduler.stopService(self)
+
+    def _build_finished(self, builderName, build, results):
+        if results not in (SUCCESS, WARNINGS):
+            return
+        properties = build.getProperties()
+        if properties.getProperty("multi_job", None):
+            return
+        if properties.getProperty("build_cached", False):
+            return
+
+        branch_name = \
+            extract_branch_name(properties.getProperty("branch", None))
+        targets = self.consumerIndex.get((builderName, branch_name))
+        if not targets:
+            return
+
+        for target in sorted(targets.keys()):
+            log.msg("%s: %s built, rebuilding %s on %s"
+                    % (self.name, builderName, ", ".join(targets[target]),
+                       target))
+            d = self.addBuildsetForLatest(
+                reason="%s built successfully" % builderName,
+                branch=target, builderNames=targets[target])
+            d.addErrback(log.err, "while rebuilding consumers of %s"
+                         % builderName)
+
+# Status receiver which calls back whenever any build finishes.
+
+class BuildFinishedWatcher(StatusReceiver):
+    def __init__(self, callback):
+        self.callback = callback
+
+    def builderAdded(self, builderName, builder):
+        return self
+
+    def buildFinished(self, builderName, build, results):
+        self.callback(builderName, build, results)
+
+# Status receiver which records how long every build took, and the
+# time and resources each of its steps used, in a metrics database (see
+# lsbmetrics.py).  The elapsed time comes from the master's clock, so it
+# covers every step, uploads included; steps run through
+# slave-scripts/lsb-measure add what they used on the slave, from the
+# "step_metrics" property.
+#
+# Given a DurationEstimator (usually lsbmetrics.shared_estimator), the
+# recorder keeps it up to date as builds finish.  Each build is also
+# given the "expected_duration" and "expected_duration_p90" properties
+# when it starts, for the status page to show.
+
+class BuildMetricsRecorder(StatusReceiverMultiService):
+    def __init__(self, path, estimator=None):
+        StatusReceiverMultiService.__init__(self)
+        self.store = lsbmetrics.MetricsStore(path)
+        self.estimator = estimator
+
+    def setServiceParent(self, parent):
+        StatusReceiverMultiService.setServiceParent(self, parent)
+        self.master_status = self.parent
+        self.master_status.subscribe(self)
+
+    def disownServiceParent(self):
+        self.master_status.unsubscribe(self)
+        self.store.close()
+        return StatusReceiverMultiService.disownServiceParent(self)
+
+    def builderAdded(self, builderName, builder):
+        return self
+
+    def buildStarted(self, builderName, build):
+        if self.estimator is None:
+            return
+        build_type = build.getProperties().getProperty("build_type", None)
+        for (name, q) in [("expected_duration", 0.5),
+                          ("expected_duration_p90", 0.9)]:
+            estimate = self.estimator.estimate(builderName,
+                                               build_type=build_type, q=q)
+            if estimate is None:
+                estimate = self.estimator.estimate(builderName, q=q)
+            if estimate is not None:
+                build.setProperty(name, int(estimate),
+                                  "BuildMetricsRecorder")
+
+    def buildFinished(self, builderName, build, results):
+        properties = build.getProperties()
+        measured = properties.getProperty("step_metrics", {})
+        steps = []
+        for step in build.getSteps():
+            (started, finished) = step.getTimes()
+            if started is None or finished is None:
+                continue
+            result = step.getResults()[0]
+            if result == SKIPPED:
+                continue
+            metrics = dict(measured.get(step.getName(), {}))
+            metrics.update({ "name": step.getName(), "result": result,
+                             "finished": finished,
+                             "elapsed": finished - started })
+            steps.append(metrics)
+
+        (started, finished) = build.getTimes()
+        row = { "builder": builderName,
+                "build_type": properties.getProperty("build_type", None),
+                "result": results,
+                "cached": properties.getProperty("build_cached", False),
+                "duration": finished - started }
+        if self.estimator is not None:
+            self.estimator.add_build(row)
+
+        try:
+            self.store.record_steps(builderName, build.getNumber(), steps)
+            self.store.record_build(builderName, build.getNumber(),
+                                    row["build_type"], results, finished,
+                                    row["duration"], row["cached"])
+        except Exception:
+            log.err(None, "while recording metrics for %s #%d"
+                    % (builderName, build.getNumber()))
+
+# The project by architecture status table on the front page (see
+# public_html/newinterface.js) used to poll each running builder for
+# its latest build, from every open browser.  Instead, this status
+# receiver keeps the whole table as one JSON document, which it only
+# rebuilds when something changes, and serves it as "matrix" under the
+# web status.  The document carries an ETag, so a page that's up to
+# date gets a bodyless 304.  Given "wait=N" and an If-None-Match that's
+# current, the request is held until the table changes (or N seconds,
+# up to max_wait, pass), so a page can follow along with one request
+# outstanding.  Bursts of changes are collected for change_delay
+# seconds before waiting pages are answered.
+#
+# The document gives the architectures (from the "lfbuild-<arch>"
+# slaves), each slave's state, and for each project and architecture,
+# the current build if there is one (with its current step), or else
+# the last finished build.
+
+class StatusMatrixResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, matrix):
+        resource.Resource.__init__(self)
+        self.matrix = matrix
+
+    def render_GET(self, request):
+        return self.matrix.render(request)
+
+class StatusMatrix(StatusReceiverMultiService):
+    slave_prefix = "lfbuild-"
+    max_wait = 60
+    change_delay = 1
+
+    def __init__(self):
+        StatusReceiverMultiService.__init__(self)
+        self.resource = StatusMatrixResource(self)
+        self.master_status = None
+        self.stamp = int(time.time())
+        self.version = 0
+        self.document = None
+        self.waiters = []
+        self.wake_timer = None
+
+    def setServiceParent(self, parent):
+        StatusReceiverMultiService.setServiceParent(self, parent)
+        self.master_status = self.parent
+        self.master_status.subscribe(self)
+
+    def disownServiceParent(self):
+        self.master_status.unsubscribe(self)
+        if self.wake_timer is not None and self.wake_timer.active():
+            self.wake_timer.cancel()
+        self._wake()
+        return StatusReceiverMultiService.disownServiceParent(self)
+
+    # Anything that might change the table throws away the document.
+
+    def _changed(self, *args):
+        self.document = None
+        if self.waiters and self.wake_timer is None:
+            self.wake_timer = reactor.callLater(self.change_delay,
+                                                self._wake)
+
+    def builderAdded(self, builderName, builder):
+        self._changed()
+        return self
+
+    builderRemoved = _changed
+    builderChangedState = _changed
+    slaveConnected = _changed
+    slaveDisconnected = _changed
+
+    def buildStarted(self, builderName, build):
+        self._changed()
+        return self
+
+    def stepStarted(self, build, step):
+        self._changed()
+
+    def buildFinished(self, builderName, build, results):
+        self._changed()
+
+    def _build_info(self, build):
+        info = { "number": build.getNumber(),
+                 "times": list(build.getTimes()) }
+        if build.isFinished():
+            info["results"] = build.getResults()
+            info["text"] = build.getText()
+        else:
+            step = build.getCurrentStep()
+            info["step"] = step and step.getName()
+            info["expected"] = build.getProperties().getProperty(
+                "expected_duration", None)
+        return info
+
+    def _build_document(self):
+        archs = set()
+        running = set()
+        connected = set()
+        projects = {}
+        for builderName in self.master_status.getBuilderNames():
+            builder = self.master_status.getBuilder(builderName)
+            builder_archs = []
+            for slave in builder.getSlaves():
+                if slave.getName().startswith(self.slave_prefix):
+                    arch = slave.getName()[len(self.slave_prefix):]
+                    builder_archs.append(arch)
+                    if slave.isConnected():
+                        connected.add(arch)
+            if not builder_archs or "-" not in builderName:
+                continue
 
-    def buildset_cb(self, setid, builderNames, properties, reason):
-        self.addBuildsetForSourceStamp(setid=setid, reason=reason,
-                                       builderNames=builderNames,
-                                       properties=properties)
+            current = builder.getCurrentBuilds()
+            for build in current:
+                slave_name = build.getSlavename()
+                if slave_name.startswith(self.slave_prefix):
+                    running.add(slave_name[len(self.slave_prefix):])
+            if current:
+                build = current[0]
+            else:
+                build = builder.getLastFinishedBuild()
+
+            project = builderName[:builderName.rindex("-")]
+            for arch in builder_archs:
+                archs.add(arch)
+                info = None
+                if build is not None:
+                    info = self._build_info(build)
+                projects.setdefault(project, {})[arch] = info
+
+        slaves = {}
+        for arch in archs:
+            if arch not in connected:
+                slaves[arch] = "offline"
+            elif arch in running:
+                slaves[arch] = "running"
+            else:
+                slaves[arch] = "idle"
+
+        self.version += 1
+        self.document = json.dumps({ "archs": sorted(archs),
+                                     "slaves": slaves,
+                                     "projects": projects },
+                                   sort_keys=True, separators=(",", ":"))
+
+    def _etag(self):
+        if self.document is None:
+            self._build_document()
+        return '"%d-%d"' % (self.stamp, self.version)
+
+    def _respond(self, request):
+        etag = self._etag()
+        request.setHeader("Content-Type", "application/json")
+        request.setHeader("Cache-Control", "no-cache")
+        if request.setETag(etag) == http.CACHED:
+            return ""
+        return self.document
+
+    def render(self, request):
+        try:
+            wait = min(int(request.args.get("wait", ["0"])[0]),
+                       self.max_wait)
+        except ValueError:
+            wait = 0
+
+        if wait > 0 and request.getHeader("If-None-Match") == self._etag():
+            timer = reactor.callLater(wait, self._finish, request)
+            waiter = (request, timer)
+            self.waiters.append(waiter)
+            request.notifyFinish().addErrback(self._gone, waiter)
+            return server.NOT_DONE_YET
+
+        return self._respond(request)
+
+    def _finish(self, request):
+        self.waiters = [w for w in self.waiters if w[0] is not request]
+        request.write(self._respond(request))
+        request.finish()
+
+    def _gone(self, failure, waiter):
+        (request, timer) = waiter
+        if timer.active():
+            timer.cancel()
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+
+    def _wake(self):
+        self.wake_timer = None
+        waiters = self.waiters
+        self.waiters = []
+        for (request, timer) in waiters:
+            timer.cancel()
+            request.write(self._respond(request))
+            request.finish()
 
 class PropMasterShellCommand(MasterShellCommand):
     def start(self):
@@ -220,17 +1134,57 @@ class PropMasterShellCommand(MasterShellCommand):
         self.command = prop.render(self.command)
         MasterShellCommand.start(self)
 
+# Base class for our build steps.  Builders which run on slaves with
+# isolated SDK roots set the "sdk_root" property; steps which use the
+# SDK then run through slave-scripts/lsb-sdk-root, against the build's
+# own copy of the SDK and package database.
+#
+# Commands also run through slave-scripts/lsb-measure, which reports the
+# wall time, CPU time, peak RSS and bytes written on the slave.  These
+# go in the "step_metrics" build property, a dict keyed by step name,
+# for BuildMetricsRecorder to pick up when the build finishes.
+
+class MeasureObserver(LogLineObserver):
+    def __init__(self):
+        LogLineObserver.__init__(self)
+        self.metrics = None
+
+    def outLineReceived(self, line):
+        if line.startswith("measure: "):
+            self.metrics = lsbmetrics.parse_measure_line(line)
+
 class LSBBuildCommand(ShellCommand):
+    uses_sdk = True
+    measure = True
+
     def __init__(self, makeargs=False, **kwargs):
         self.do_make_args = makeargs
         ShellCommand.__init__(self, **kwargs)
         self.addFactoryArguments(makeargs=makeargs)
 
-    def _get_make_args(self):
-        "Get any special make arguments needed."
+        self.measure_observer = MeasureObserver()
+        self.addLogObserver("stdio", self.measure_observer)
+
+    def _get_slave_cpus(self):
+        "Get the slave's CPU count, if a step has found it out."
+
+        try:
+            return int(self.getProperty("slave_cpus", 0))
+        except ValueError:
+            return 0
+
+    def _get_make_args(self, share=1):
+        """Get any special make arguments needed.
+
+        If we know how many CPUs the slave has, make gets a -j option to
+        use its share of them."""
 
         args = []
 
+        make_jobs = self._get_slave_cpus() // share
+        if make_jobs > 1:
+            args.append("-j%d" % make_jobs)
+
         branch_name = self.getProperty("branch_name")
         lsb_version = self.getProperty("lsb_version", None)
         found_lsb_version = False
@@ -300,14 +1254,180 @@ class LSBBuildCommand(ShellCommand):
                 result_type = result_type + "-" + build_type
         self.setProperty("result_type", result_type)
 
+    def _wrap_sdk_root(self):
+        "Run the command against the build's private SDK, if it has one."
+
+        sdk_root = self.getProperty("sdk_root", None)
+        if not sdk_root or not self.uses_sdk:
+            return
+
+        command = self.command
+        if isinstance(command, basestring):
+            command = ["sh", "-c", command]
+        self.setCommand(["../bin/lsb-sdk-root", sdk_root, "--"] +
+                        list(command))
+
+    def _wrap_measure(self):
+        "Measure what the command uses on the slave."
+
+        if not self.measure:
+            return
+
+        command = self.command
+        if isinstance(command, basestring):
+            command = ["sh", "-c", command]
+        self.setCommand(["../bin/lsb-measure", "--"] + list(command))
+
     def start(self):
         self._set_build_props()
 
         if self.do_make_args:
             self.setCommand(self.command + " " + " ".join(self._get_make_args()))
 
+        self._wrap_sdk_root()
+        self._wrap_measure()
         ShellCommand.start(self)
 
+    def commandComplete(self, cmd):
+        ShellCommand.commandComplete(self, cmd)
+
+        if self.measure_observer.metrics:
+            step_metrics = dict(self.getProperty("step_metrics", {}))
+            step_metrics[self.name] = self.measure_observer.metrics
+            self.setProperty("step_metrics", step_metrics, "LSBBuildCommand")
+
+# Plain shell commands (packing results, say) which don't need the SDK,
+# but whose use of the slave we want measured all the same.
+
+class LSBShellCommand(LSBBuildCommand):
+    uses_sdk = False
+
+# Check out a bzr branch through the slave's shared bzr cache (see
+# slave-scripts/lsb-bzr-checkout), updating an existing tree in place
+# when it's already a checkout of the right branch.  Give either a full
+# repourl (which may use properties), or a baseURL and defaultBranch; in
+# the latter case, the build's branch and revision are used if set.  The
+# main checkout (dest ".") sets got_revision to the revno of the tree it
+# checked out.  Every checkout records the tree's revision id (None if
+# it couldn't tell) in the "checkout_revisions" property, by dest; a
+# revno can name a different tree after an uncommit or an overwriting
+# push, but a revision id can't.  Every checkout adds the time it took
+# to the "checkout_seconds" property, so version control time can be
+# told apart from build time.
+
+class LSBBzrCheckout(LSBBuildCommand):
+    command = ["placeholder"]
+    uses_sdk = False
+    name = "checkout"
+    description = ["checking", "out"]
+    descriptionDone = ["checkout"]
+
+    def __init__(self, repourl=None, baseURL=None, defaultBranch=None,
+                 dest=".", alwaysUseLatest=False, **kwargs):
+        if repourl is None and baseURL is None:
+            raise ValueError("LSBBzrCheckout needs a repourl or a baseURL")
+        self.repourl = repourl
+        self.baseURL = baseURL
+        self.defaultBranch = defaultBranch
+        self.dest = dest
+        self.alwaysUseLatest = alwaysUseLatest
+        LSBBuildCommand.__init__(self, **kwargs)
+        self.addFactoryArguments(repourl=repourl, baseURL=baseURL,
+                                 defaultBranch=defaultBranch, dest=dest,
+                                 alwaysUseLatest=alwaysUseLatest)
+
+    def _get_url(self):
+        if self.repourl is not None:
+            return self.build.getProperties().render(self.repourl)
+
+        branch = self.getProperty("branch", None) or self.defaultBranch
+        return self.baseURL + branch
+
+    def start(self):
+        self._set_build_props()
+
+        command = ["../bin/lsb-bzr-checkout"]
+        revision = self.getProperty("revision", None)
+        if revision and not self.alwaysUseLatest:
+            command.extend(["-r", str(revision)])
+        command.extend([self._get_url(), self.dest])
+        self.setCommand(command)
+
+        LSBBuildCommand.start(self)
+
+    def commandComplete(self, cmd):
+        LSBBuildCommand.commandComplete(self, cmd)
+
+        revision_id = None
+        for line in self.getLog("stdio").readlines():
+            match = re.match(r'^revision: (\S+)$', line.strip())
+            if match and self.dest == ".":
+                self.setProperty("got_revision", match.group(1),
+                                 "LSBBzrCheckout")
+            match = re.match(r'^revision-id: (\S+)$', line.strip())
+            if match:
+                revision_id = match.group(1)
+            match = re.match(r'^elapsed: ([\d.]+)$', line.strip())
+            if match:
+                total = self.getProperty("checkout_seconds", 0.0) + \
+                    float(match.group(1))
+                self.setProperty("checkout_seconds", total, "LSBBzrCheckout")
+
+        revisions = dict(self.getProperty("checkout_revisions", {}))
+        revisions[self.dest] = revision_id
+        self.setProperty("checkout_revisions", revisions, "LSBBzrCheckout")
+
+# Run several build commands side by side on the slave (see
+# slave-scripts/lsb-parallel), for parts of a build which don't depend on
+# each other.  The jobs are (name, directory, command) tuples, with the
+# directory relative to the step's workdir.  With makeargs, each command
+# gets the make arguments, with the slave's CPUs shared out between the
+# jobs running at once.  By default, as many jobs run at once as the
+# slave has CPUs.  Each job's output also goes in a log of its own.
+
+class LSBParallelBuild(LSBBuildCommand):
+    command = ["placeholder"]
+
+    def __init__(self, jobs=[], maxParallel=None, **kwargs):
+        self.jobs = jobs
+        self.maxParallel = maxParallel
+        LSBBuildCommand.__init__(self, **kwargs)
+        self.addFactoryArguments(jobs=jobs, maxParallel=maxParallel)
+
+    def _get_parallel(self):
+        if self.maxParallel:
+            return self.maxParallel
+        cpus = self._get_slave_cpus()
+        if cpus:
+            return max(1, min(cpus, len(self.jobs)))
+        return len(self.jobs)
+
+    def start(self):
+        self._set_build_props()
+
+        parallel = self._get_parallel()
+        command = ["../bin/lsb-parallel", "-j", str(parallel)]
+        for (name, directory, job_command) in self.jobs:
+            if self.do_make_args:
+                job_command = job_command + " " + \
+                    " ".join(self._get_make_args(share=parallel))
+            command.extend(["--job", name, directory, job_command])
+        self.setCommand(command)
+
+        self._wrap_sdk_root()
+        self._wrap_measure()
+        ShellCommand.start(self)
+
+    def createSummary(self, log):
+        job_output = dict([(name, []) for (name, d, c) in self.jobs])
+        for line in log.readlines():
+            if "| " in line:
+                (name, text) = line.split("| ", 1)
+                if name in job_output:
+                    job_output[name].append(text)
+        for (name, d, c) in self.jobs:
+            self.addCompleteLog(name, "".join(job_output[name]))
+
 class LSBBuildPackage(LSBBuildCommand):
     def __init__(self, makeargs=False, **kwargs):
         if "command" not in kwargs:
@@ -316,7 +1436,7 @@ class LSBBuildPackage(LSBBuildCommand):
         LSBBuildCommand.__init__(self, makeargs=makeargs, **kwargs)
 
 # Automate some of the packaging build.  When using this, be sure to check
-# out a copy of "packaging" (via ShellCommand, as buildbot's source stuff
+# out a copy of "packaging" (via LSBBzrCheckout, as buildbot's source stuff
 # can't currently handle multi-repo builds), that your source checkout
 # uses a named build dir that's the same as the project, and that BZRTREES
 # is set to "..".
@@ -361,7 +1481,16 @@ class LSBConfigureAppbat(LSBBuildCommand):
                 cmd.args['env'][name] = value
 
 # Reload the SDK.  This class figures out what SDK we need (devel, stable,
-# or beta) and installs it.
+# or beta) and installs it.  Reinstalling takes minutes, and most builds
+# want the same SDK as the one before, so we fingerprint the SDK we want
+# (build type, branch, and the hash of the slave's saved SDK tarball)
+# and skip the reload if the slave's recorded fingerprint matches.  The
+# SDK builds, which replace the installed SDK, remove the record.  The
+# "sdk_reloaded" property says which way it went.
+
+# Where the fingerprint of the installed SDK is kept, relative to the
+# build's workdir.  Builds in isolated SDK roots keep it in the root.
+sdk_fingerprint_file = "${LSB_SDK_ROOT:-../..}/sdk.fingerprint"
 
 class LSBReloadSDK(LSBBuildCommand):
     command = ["placeholder"]
@@ -396,13 +1525,120 @@ class LSBReloadSDK(LSBBuildCommand):
             slave_id = m.group(1)
 
         if self._is_beta():
-            self.setCommand(['reset-sdk', '--beta'])
+            reload_command = "reset-sdk --beta"
         elif self._is_devel():
-            self.setCommand(['update-sdk'])
+            reload_command = "update-sdk"
         else:
-            self.setCommand(['reset-sdk'])
+            reload_command = "reset-sdk"
+
+        fingerprint = "%s %s $(sha256sum ../../saved/%s/sdk.tar.gz " \
+            "2>/dev/null | cut -d' ' -f1)" \
+            % (self.getProperty("build_type"), self.getProperty("branch_name"),
+               self.getProperty("result_type"))
+        self.setCommand(
+            'fp="%s"; fpfile="%s"; '
+            'if [ -f "$fpfile" ] && [ "$(cat "$fpfile")" = "$fp" ]; then '
+            'echo "SDK fingerprint hit: $fp"; '
+            'else echo "SDK fingerprint miss: $fp"; rm -f "$fpfile"; '
+            '%s && echo "$fp" > "$fpfile"; fi'
+            % (fingerprint, sdk_fingerprint_file, reload_command))
+        LSBBuildCommand.start(self)
+
+    def commandComplete(self, cmd):
+        LSBBuildCommand.commandComplete(self, cmd)
+
+        for line in self.getLog("stdio").readlines():
+            if line.startswith("SDK fingerprint hit:"):
+                self.setProperty("sdk_reloaded", False, "LSBReloadSDK")
+            elif line.startswith("SDK fingerprint miss:"):
+                self.setProperty("sdk_reloaded", True, "LSBReloadSDK")
+
+# Build avoidance.  Once a build has its checkouts, SDK and dependencies
+# in place, LSBBuildCache works out a fingerprint of them (see
+# slave-scripts/lsb-buildcache), and if an earlier build with the same
+# fingerprint kept its results, puts them where the build would have
+# packed its own.  The build then skips the steps given
+# doStepIf=build_not_cached, sets the "build_cached" property, and
+# uploads the reused results as usual.  After a build which did run and
+# succeeded, steps given doStepIf=build_cache_miss keep its results for
+# next time.  Only builds whose build_type is in buildTypes use the
+# cache; beta and production builds should always build for real.
+#
+# The deps are (branch, name) pairs for the saved results the build
+# installs; the branch may use properties.  Checkouts go into the
+# fingerprint by revision id, and if any checkout couldn't report one,
+# the cache isn't used at all.  The make job count is left out of the
+# fingerprint, as it doesn't change what gets built.
+
+def build_not_cached(step):
+    return not step.build.getProperties().getProperty("build_cached", False)
+
+def build_cache_miss(step):
+    properties = step.build.getProperties()
+    return bool(properties.getProperty("input_fingerprint", None)) and \
+        not properties.getProperty("build_cached", False) and \
+        step.build.result in (SUCCESS, WARNINGS)
+
+def build_cache_wanted(step):
+    step._set_build_props()
+    revisions = step.getProperty("checkout_revisions", {})
+    return step.getProperty("build_type") in step.buildTypes and \
+        bool(revisions) and None not in revisions.values()
+
+class LSBBuildCache(LSBBuildCommand):
+    command = ["placeholder"]
+    name = "check-build-cache"
+    description = ["checking", "build", "cache"]
+    descriptionDone = ["build", "cache"]
+
+    def __init__(self, buildName, tarball, deps=[],
+                 buildTypes=["normal", "devel"], **kwargs):
+        self.buildName = buildName
+        self.tarball = tarball
+        self.deps = deps
+        self.buildTypes = buildTypes
+        kwargs.setdefault("doStepIf", build_cache_wanted)
+        kwargs.setdefault("flunkOnFailure", False)
+        LSBBuildCommand.__init__(self, **kwargs)
+        self.addFactoryArguments(buildName=buildName, tarball=tarball,
+                                 deps=deps, buildTypes=buildTypes)
+
+    def start(self):
+        self._set_build_props()
+
+        properties = self.build.getProperties()
+        command = ["../bin/lsb-buildcache", "check", "--name",
+                   self.buildName]
+        revisions = self.getProperty("checkout_revisions", {})
+        for dest in sorted(revisions.keys()):
+            command.extend(["--input",
+                            "checkout:%s=%s" % (dest, revisions[dest])])
+        make_args = [x for x in self._get_make_args()
+                     if not x.startswith("-j")]
+        command.extend(["--input", "make=" + " ".join(make_args)])
+        for (branch, name) in self.deps:
+            command.extend(["--dep", "%s/%s" % (properties.render(branch),
+                                                name)])
+        command.append(self.tarball)
+        self.setCommand(command)
+
         LSBBuildCommand.start(self)
 
+    def commandComplete(self, cmd):
+        LSBBuildCommand.commandComplete(self, cmd)
+
+        cached = False
+        for line in self.getLog("stdio").readlines():
+            match = re.match(r'^fingerprint: (\S+)$', line.strip())
+            if match:
+                self.setProperty("input_fingerprint", match.group(1),
+                                 "LSBBuildCache")
+            elif line.strip() == "cache: hit":
+                cached = True
+        self.setProperty("build_cached", cached, "LSBBuildCache")
+        if cached:
+            self.descriptionDone = ["reused", "results"]
+
 # We use emailed commit messages to trigger builds now.  It turns out
 # that upstream's Launchpad email parser is almost a perfect match
 # for the commit emails bzr-hookless creates... except for a few little
@@ -413,9 +1649,165 @@ class LSBReloadSDK(LSBBuildCommand):
 # original parser can handle a missing branchMap in some places, but
 # those will almost certainly be wrong here; consider branchMap to be
 # mandatory.
+#
+# A push of many revisions sends one email per revision, and every
+# change wakes up the schedulers.  So new mail isn't parsed as it
+# arrives; it's collected for coalesceDelay seconds, and then each
+# branch's revisions are turned into a single change for the newest
+# revision, with the range it covers in the "revision_range" property.
+# Before any of that, the headers alone are checked, so mail for
+# branches we don't build, and second deliveries of the same message
+# (by Message-ID), are dropped without parsing the rest.  Mail is only
+# moved out of "new" once it's handled, so anything still waiting when
+# the master stops is picked up again when it starts.
+
+lsb_subject_re = re.compile(r'^\[Lsb-messages\] (\S+) r(\d+):')
+
+# How many Message-IDs to remember, for spotting duplicate deliveries.
+recent_message_ids = 1000
+
+def read_headers(fd):
+    "Parse just the headers of a message file."
+
+    lines = []
+    for line in fd:
+        if not line.strip():
+            break
+        lines.append(line)
+    return HeaderParser().parsestr("".join(lines), headersonly=True)
+
+def revision_key(change):
+    try:
+        return int(change.get('revision'))
+    except (TypeError, ValueError):
+        return 0
 
 class BzrLsbMaildirSource(BzrLaunchpadEmailMaildirSource):
     name = "bzr hookless message (LSB-specific)"
+    compare_attrs = BzrLaunchpadEmailMaildirSource.compare_attrs + \
+        ["coalesceDelay"]
+
+    def __init__(self, maildir, coalesceDelay=5, **kwargs):
+        BzrLaunchpadEmailMaildirSource.__init__(self, maildir, **kwargs)
+        self.coalesceDelay = coalesceDelay
+        self.pending = []
+        self.flusher = None
+        self.seen_ids = set()
+        self.seen_order = deque()
+
+    def stopService(self):
+        if self.flusher is not None and self.flusher.active():
+            self.flusher.cancel()
+        self.flusher = None
+        self.pending = []
+        return BzrLaunchpadEmailMaildirSource.stopService(self)
+
+    def messageReceived(self, filename):
+        if filename not in self.pending:
+            self.pending.append(filename)
+        if self.flusher is None or not self.flusher.active():
+            self.flusher = reactor.callLater(self.coalesceDelay, self.flush)
+        return defer.succeed(None)
+
+    def flush(self):
+        "Turn the mail collected so far into one change per branch."
+
+        self.flusher = None
+        (filenames, self.pending) = (self.pending, [])
+
+        groups = {}
+        order = []
+        for filename in filenames:
+            try:
+                f = self.moveToCurDir(filename)
+            except (IOError, OSError), e:
+                log.msg("%s: could not read '%s': %s"
+                        % (self.name, filename, str(e)))
+                continue
+            # The batch's files are all in cur/ by now, so one bad
+            # message mustn't lose the rest of them.
+            try:
+                chtuple = self.parse_file(f, self.prefix)
+            except:
+                log.err(None, "%s: could not parse '%s'"
+                        % (self.name, filename))
+                continue
+            finally:
+                f.close()
+            if not chtuple or not chtuple[1]:
+                continue
+
+            (src, chdict) = chtuple
+            key = (src, chdict.get('repository'), chdict.get('branch'))
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(chdict)
+
+        dl = []
+        for key in order:
+            changes = groups[key]
+            if len(changes) > 1:
+                log.msg("%s: coalesced %d revisions on %s"
+                        % (self.name, len(changes), key[2]))
+            d = self.master.addChange(src=key[0],
+                                      **self.coalesce(changes))
+            d.addErrback(log.err, "while adding a change for %s" % key[2])
+            dl.append(d)
+        return defer.DeferredList(dl)
+
+    def coalesce(self, changes):
+        "Collapse a branch's changes into one, for its newest revision."
+
+        if len(changes) == 1:
+            return changes[0]
+
+        changes.sort(key=revision_key)
+        chdict = dict(changes[-1])
+
+        files = []
+        seen_files = set()
+        for change in changes:
+            for f in change.get('files') or []:
+                if f not in seen_files:
+                    seen_files.add(f)
+                    files.append(f)
+        chdict['files'] = files
+
+        revision_range = "%s..%s" % (changes[0].get('revision'),
+                                     changes[-1].get('revision'))
+        chdict['comments'] = "Revisions %s:\n\n" % revision_range + \
+            "\n\n".join([c.get('comments') or "" for c in changes])
+        properties = dict(chdict.get('properties') or {})
+        properties['revision_range'] = revision_range
+        chdict['properties'] = properties
+        return chdict
+
+    def wanted(self, headers):
+        "Check a message's headers before parsing the whole thing."
+
+        match = lsb_subject_re.search((headers['subject'] or "").strip())
+        if not match or match.group(1) not in self.branchMap:
+            return False
+
+        message_id = headers['message-id']
+        if message_id:
+            message_id = message_id.strip()
+            if message_id in self.seen_ids:
+                log.msg("%s: ignoring duplicate message %s"
+                        % (self.name, message_id))
+                return False
+            self.seen_ids.add(message_id)
+            self.seen_order.append(message_id)
+            if len(self.seen_order) > recent_message_ids:
+                self.seen_ids.discard(self.seen_order.popleft())
+        return True
+
+    def parse_file(self, fd, prefix=None):
+        if not self.wanted(read_headers(fd)):
+            return None
+        fd.seek(0)
+        return BzrLaunchpadEmailMaildirSource.parse_file(self, fd, prefix)
 
     def parse(self, m, prefix=None):
         "Parse branch notification messages sent by bzr-hookless-email."
@@ -423,8 +1815,7 @@ class BzrLsbMaildirSource(BzrLaunchpadEmailMaildirSource):
         # Right now, the Subject line is the only troublesome part.
 
         subject = m['subject']
-        match = re.search(r'^\[Lsb-messages\] (\S+) r(\d+):',
-                          subject.strip())
+        match = lsb_subject_re.search(subject.strip())
         if match:
             raw_branch = match.group(1)
             if raw_branch in self.branchMap:
@@ -0,0 +1,206 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Build dependency graph for the LSB builders.
+#
+# Every build needs the SDK, so "build-sdk" sits at the root of the
+# graph; the projects built as part of the SDK are just other names for
+# it.  Below that, the dependencies from the master config say which
+# projects need another project's saved results to build.  We work out
+# a topological order once, when the config is loaded, so that the
+# builder prioritizer and the schedulers only have to do dictionary
+# lookups afterwards.
+#
+# Given estimates of how long each build takes (see
+# lsbmetrics.DurationEstimator), the prioritizer puts the builders at
+# the head of the longest chains of builds first, so a full run of
+# every project finishes as early as it can.  A chain's length is the
+# time from the start of its first build to the end of its last.  Every
+# build needs the SDK, so build-sdk still always goes first.
+
+class DependencyCycle(Exception):
+    pass
+
+def dependency_name(dep_entry):
+    "Dependency entries are either a project name or (name, packages)."
+
+    if isinstance(dep_entry, tuple):
+        return dep_entry[0]
+    else:
+        return dep_entry
+
+class BuildDAG:
+    def __init__(self, dependencies, sdk_projects=[], root="build-sdk"):
+        self.root = root
+        self.aliases = {}
+        for sdk_project in sdk_projects:
+            self.aliases[sdk_project] = root
+
+        # Direct producers and consumers for each project.
+        self.producers = {root: set()}
+        self.consumers = {root: set()}
+        for (project, deps) in dependencies.items():
+            project = self.resolve(project)
+            self.producers.setdefault(project, set())
+            self.consumers.setdefault(project, set())
+            for dep_entry in deps:
+                dep = self.resolve(dependency_name(dep_entry))
+                self.producers.setdefault(dep, set())
+                self.consumers.setdefault(dep, set())
+                self.producers[project].add(dep)
+                self.consumers[dep].add(project)
+
+        self.order = self._sort()
+
+        # Projects which something else waits on are ranked in build
+        # order; everything else comes after them, in no particular order.
+        self.rank = {}
+        for project in self.order:
+            if project == root or self.consumers[project]:
+                self.rank[project] = len(self.rank)
+        self.default_rank = len(self.rank)
+
+        self._ancestors = {}
+        self._builder_ranks = {}
+        self._builder_projects = {}
+        self._known_prefixes = sorted(self.producers.keys(),
+                                      key=len, reverse=True)
+
+        # Critical path lengths for each builder suffix, along with the
+        # estimator version they were worked out from.
+        self._paths = {}
+
+    # Reconfiguring the master compares schedulers that use the graph,
+    # so two graphs built from the same tables should compare equal.
+
+    def __eq__(self, other):
+        return isinstance(other, BuildDAG) and \
+            (self.root, self.aliases, self.producers) == \
+            (other.root, other.aliases, other.producers)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def resolve(self, project):
+        "Map SDK component projects onto the SDK build itself."
+
+        return self.aliases.get(project, project)
+
+    def _sort(self):
+        "Topologically sort the graph, producers first."
+
+        order = []
+        remaining = dict([(prj, set(deps))
+                          for (prj, deps) in self.producers.items()])
+        ready = [self.root] + \
+            sorted([prj for (prj, deps) in remaining.items()
+                    if not deps and prj != self.root])
+        while ready:
+            project = ready.pop(0)
+            order.append(project)
+            del remaining[project]
+            for consumer in sorted(self.consumers[project]):
+                remaining[consumer].discard(project)
+                if not remaining[consumer] and consumer not in ready:
+                    ready.append(consumer)
+
+        if remaining:
+            raise DependencyCycle("dependency cycle among: " +
+                                  ", ".join(sorted(remaining.keys())))
+
+        return order
+
+    def ancestors(self, project):
+        "Return every project that must be built before this one."
+
+        project = self.resolve(project)
+        if project in self._ancestors:
+            return self._ancestors[project]
+
+        found = set()
+        if project != self.root:
+            found.add(self.root)
+        pending = list(self.producers.get(project, []))
+        while pending:
+            dep = pending.pop()
+            if dep not in found:
+                found.add(dep)
+                pending.extend(self.producers.get(dep, []))
+
+        self._ancestors[project] = found
+        return found
+
+    def builder_project(self, builder_name):
+        """Split a builder named <project>-<arch or slave id>.
+
+        Returns (project, suffix), with project None if the builder
+        isn't for a project in the graph."""
+
+        if builder_name not in self._builder_projects:
+            found = (None, None)
+            for project in self._known_prefixes:
+                if builder_name.startswith(project + "-"):
+                    found = (project, builder_name[len(project) + 1:])
+                    break
+            self._builder_projects[builder_name] = found
+
+        return self._builder_projects[builder_name]
+
+    def builder_rank(self, builder_name):
+        "Rank a builder named <project>-<arch or slave id>."
+
+        if builder_name not in self._builder_ranks:
+            (project, suffix) = self.builder_project(builder_name)
+            self._builder_ranks[builder_name] = \
+                self.rank.get(project, self.default_rank)
+
+        return self._builder_ranks[builder_name]
+
+    def critical_paths(self, suffix, estimator):
+        """Work out the critical path from each project, on one arch.
+
+        Returns a dict mapping each project to the expected time from
+        the start of its build to the end of the longest chain of
+        builds that wait on it."""
+
+        cached = self._paths.get(suffix)
+        if cached and cached[0] == estimator.version:
+            return cached[1]
+
+        paths = {}
+        for project in reversed(self.order):
+            longest = max([paths[c] for c in self.consumers[project]] or [0])
+
+            # Every build takes some time, so producers always come out
+            # ahead of their consumers.
+            duration = max(estimator.expected("%s-%s" % (project, suffix)),
+                           1)
+            paths[project] = duration + longest
+
+        self._paths[suffix] = (estimator.version, paths)
+        return paths
+
+    def builder_path(self, builder_name, estimator):
+        "The critical path for a builder, in seconds."
+
+        (project, suffix) = self.builder_project(builder_name)
+        if project is None:
+            return estimator.expected(builder_name)
+        return self.critical_paths(suffix, estimator)[project]
+
+    def prioritize(self, builders, estimator=None):
+        """Sort builder objects so that producers run before consumers.
+
+        With an estimator, the builders heading the longest chains of
+        builds go first."""
+
+        if estimator is None:
+            return sorted(builders, key=lambda b: self.builder_rank(b.name))
+
+        def priority(builder):
+            (project, suffix) = self.builder_project(builder.name)
+            return (project != self.root,
+                    -self.builder_path(builder.name, estimator),
+                    self.builder_rank(builder.name))
+
+        return sorted(builders, key=priority)
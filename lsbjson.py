@@ -0,0 +1,176 @@
+# Client for buildbot's JSON status interface.
+#
+# Scripts which look at the state of the builders (low-resource-jobs,
+# for one) used to make one blocking request per builder, which adds up
+# to hundreds of round trips when run across several architectures.
+# This client asks for many resources at once using the JSON interface's
+# "select" argument, falls back to fetching them concurrently if the
+# batch fails, and keeps responses in an on-disk cache for a while so
+# that scripts run from cron every few minutes stay cheap.
+
+import os
+import time
+import json
+import hashlib
+import urllib
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+class BuildbotJSON:
+    def __init__(self, url, cache_dir=None, ttl=0, threads=8, timeout=60,
+                 batch_size=40):
+        self.url = url.rstrip("/")
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.threads = threads
+        self.timeout = timeout
+        self.batch_size = batch_size
+
+        if self.cache_dir and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    # Cache entries hold the response along with its validators, so
+    # that stale entries can be refreshed with a conditional request.
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(url).hexdigest() + ".json")
+
+    def _read_cache(self, url):
+        if not self.cache_dir:
+            return None
+        try:
+            return json.load(open(self._cache_path(url)))
+        except (IOError, ValueError):
+            return None
+
+    def _write_cache(self, url, entry):
+        if not self.cache_dir:
+            return
+        path = self._cache_path(url)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        f = open(tmp_path, "w")
+        try:
+            json.dump(entry, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+    def fetch(self, url):
+        "Fetch and decode a URL, using the cache if we can."
+
+        entry = self._read_cache(url)
+        if entry and time.time() - entry["fetched"] < self.ttl:
+            return entry["data"]
+
+        request = urllib2.Request(url)
+        if entry:
+            if entry.get("etag"):
+                request.add_header("If-None-Match", entry["etag"])
+            if entry.get("last_modified"):
+                request.add_header("If-Modified-Since",
+                                   entry["last_modified"])
+
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError, e:
+            if e.code == 304 and entry:
+                entry["fetched"] = time.time()
+                self._write_cache(url, entry)
+                return entry["data"]
+            raise
+
+        try:
+            data = json.loads(response.read())
+            info = response.info()
+        finally:
+            response.close()
+
+        self._write_cache(url, { "fetched": time.time(),
+                                 "etag": info.getheader("ETag"),
+                                 "last_modified":
+                                     info.getheader("Last-Modified"),
+                                 "data": data })
+        return data
+
+    def get(self, path):
+        return self.fetch("%s/%s" % (self.url,
+                                     urllib.quote(path.strip("/"), "/")))
+
+    def get_many(self, paths):
+        """Fetch several resources concurrently.
+
+        Returns a dict mapping each path to its data, or to None if it
+        couldn't be fetched."""
+
+        def fetch_one(path):
+            try:
+                return (path, self.get(path))
+            except (urllib2.URLError, ValueError):
+                return (path, None)
+
+        if not paths:
+            return {}
+        pool = ThreadPool(min(self.threads, len(paths)))
+        try:
+            return dict(pool.map(fetch_one, paths))
+        finally:
+            pool.close()
+            pool.join()
+
+    def select(self, paths):
+        """Fetch several resources, as few requests as possible.
+
+        Returns the same thing as get_many."""
+
+        results = {}
+        paths = [p.strip("/") for p in paths]
+        for start in range(0, len(paths), self.batch_size):
+            batch = paths[start:start + self.batch_size]
+            query = urllib.urlencode([("select", p) for p in batch])
+            try:
+                data = self.fetch("%s/?%s" % (self.url, query))
+            except (urllib2.URLError, ValueError):
+                # One bad path spoils the whole batch; find out which.
+                results.update(self.get_many(batch))
+                continue
+
+            # The response nests each selected resource under its path
+            # components.
+            for path in batch:
+                node = data
+                for element in path.split("/"):
+                    if not isinstance(node, dict) or element not in node:
+                        node = None
+                        break
+                    node = node[element]
+                results[path] = node
+
+        return results
+
+    def recent_builds(self, builder_names, count=1):
+        """Get the last few builds for each of a list of builders.
+
+        Returns a dict mapping each builder to a list of its builds,
+        newest first; builds that don't exist are left out."""
+
+        paths = {}
+        for name in builder_names:
+            for n in range(1, count + 1):
+                paths["builders/%s/builds/-%d" % (name, n)] = (name, n)
+        results = self.select(paths.keys())
+
+        builds = dict([(name, [None] * count) for name in builder_names])
+        for (path, data) in results.items():
+            (name, n) = paths[path]
+            builds[name][n - 1] = data
+        for (name, name_builds) in builds.items():
+            builds[name] = [b for b in name_builds if b and "times" in b]
+        return builds
+
+    def last_builds(self, builder_names):
+        "Get the most recent build for each of a list of builders."
+
+        builds = self.recent_builds(builder_names)
+        return dict([(name, name_builds and name_builds[0] or None)
+                     for (name, name_builds) in builds.items()])
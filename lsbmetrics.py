@@ -0,0 +1,285 @@
+# Build and step metrics, kept in a SQLite database on the master.
+#
+# Every step of every LSB build gets a row: how long it took by the
+# master's clock and, for steps which run through slave-scripts/
+# lsb-measure, the wall time, CPU time, peak RSS and bytes written on
+# the slave.  Every build gets a row with its duration too.
+# lfbuildbot.BuildMetricsRecorder writes the rows as builds finish; the
+# step-metrics script reads them back, per builder, architecture or
+# step, to find the slow steps and see when one got slower.
+#
+# The build durations also feed a DurationEstimator, which keeps the
+# recent history in memory so the schedulers can ask how long a build
+# usually takes without going to the database.
+
+import re
+import time
+import sqlite3
+from collections import deque
+
+schema = """
+create table if not exists step_metrics (
+    finished real not null,
+    builder text not null,
+    arch text,
+    build_number integer not null,
+    step text not null,
+    result integer,
+    elapsed real,
+    wall real,
+    user_cpu real,
+    sys_cpu real,
+    maxrss integer,
+    written integer
+);
+create index if not exists step_metrics_builder
+    on step_metrics (builder, step, finished);
+create index if not exists step_metrics_arch
+    on step_metrics (arch, step, finished);
+create table if not exists build_durations (
+    finished real not null,
+    builder text not null,
+    arch text,
+    build_number integer not null,
+    build_type text,
+    result integer,
+    cached integer not null default 0,
+    duration real not null
+);
+create index if not exists build_durations_finished
+    on build_durations (finished);
+"""
+
+# The metrics lsb-measure reports, as they appear in its output line,
+# and the columns they go in.
+measure_fields = [("wall", "wall", float), ("user", "user_cpu", float),
+                  ("sys", "sys_cpu", float), ("maxrss", "maxrss", int),
+                  ("written", "written", int)]
+
+measure_re = re.compile(r'^measure: (.*)$')
+
+def parse_measure_line(line):
+    "Turn an lsb-measure output line into a dict of metrics, or None."
+
+    match = measure_re.match(line.strip())
+    if not match:
+        return None
+    values = dict([item.split("=", 1) for item in match.group(1).split()
+                   if "=" in item])
+    metrics = {}
+    try:
+        for (field, column, convert) in measure_fields:
+            if field in values:
+                metrics[column] = convert(values[field])
+    except ValueError:
+        return None
+    return metrics
+
+def builder_arch(builder_name):
+    "Regular builders have their architecture tacked on the end."
+
+    match = re.search(r'-([^\-]+)$', builder_name)
+    if match:
+        return match.group(1)
+    return None
+
+class MetricsStore:
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path)
+            self.db.row_factory = sqlite3.Row
+            self.db.executescript(schema)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def record_steps(self, builder, build_number, steps):
+        """Add a finished build's steps.
+
+        Each step is a dict with the step's name, result, finished time
+        and elapsed time, plus whatever lsb-measure columns it has."""
+
+        db = self.connect()
+        arch = builder_arch(builder)
+        rows = []
+        for step in steps:
+            rows.append((step["finished"], builder, arch, build_number,
+                         step["name"], step.get("result"),
+                         step.get("elapsed"), step.get("wall"),
+                         step.get("user_cpu"), step.get("sys_cpu"),
+                         step.get("maxrss"), step.get("written")))
+        db.executemany("insert into step_metrics values "
+                       "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        db.commit()
+
+    def record_build(self, builder, build_number, build_type, result,
+                     finished, duration, cached=False):
+        db = self.connect()
+        db.execute("insert into build_durations values "
+                   "(?, ?, ?, ?, ?, ?, ?, ?)",
+                   (finished, builder, builder_arch(builder), build_number,
+                    build_type, result, int(bool(cached)), duration))
+        db.commit()
+
+    def builds(self, since=None):
+        "Recorded builds, oldest first."
+
+        if since is None:
+            since = 0
+        return self.connect().execute(
+            "select * from build_durations where finished >= ? "
+            "order by finished", (since,)).fetchall()
+
+    def _where(self, builder=None, arch=None, step=None, since=None):
+        clauses = []
+        args = []
+        for (column, value) in [("builder", builder), ("arch", arch),
+                                ("step", step)]:
+            if value is not None:
+                clauses.append("%s = ?" % column)
+                args.append(value)
+        if since is not None:
+            clauses.append("finished >= ?")
+            args.append(since)
+        if clauses:
+            return (" where " + " and ".join(clauses), args)
+        return ("", args)
+
+    def summary(self, group_by="step", builder=None, arch=None, step=None,
+                since=None):
+        """Totals and averages for each step, builder or arch, slowest
+        (by total time) first."""
+
+        if group_by not in ("step", "builder", "arch"):
+            raise ValueError("can't group by %s" % group_by)
+        (where, args) = self._where(builder, arch, step, since)
+        return self.connect().execute(
+            "select %s as name, count(*) as runs, "
+            "sum(elapsed) as total, avg(elapsed) as average, "
+            "max(elapsed) as longest, avg(user_cpu + sys_cpu) as cpu, "
+            "max(maxrss) as maxrss, avg(written) as written "
+            "from step_metrics%s group by %s order by total desc"
+            % (group_by, where, group_by), args).fetchall()
+
+    def history(self, builder=None, arch=None, step=None, since=None,
+                limit=50):
+        "The most recent runs matching, newest first."
+
+        (where, args) = self._where(builder, arch, step, since)
+        return self.connect().execute(
+            "select * from step_metrics%s order by finished desc limit ?"
+            % where, args + [limit]).fetchall()
+
+def days_ago(days):
+    return time.time() - days * 24 * 60 * 60
+
+# Successful build results, as buildbot numbers them (SUCCESS and
+# WARNINGS).  Failed builds usually stop early, so they'd make builds
+# look quicker than they are.
+good_results = (0, 1)
+
+# How long we assume a build takes when we know nothing about it, or
+# anything else on its architecture, in seconds.
+default_duration = 3600
+
+def quantile(values, q):
+    "The q quantile of a sorted list, by nearest rank."
+
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class DurationEstimator:
+    """Median and 90th percentile build durations, kept in memory.
+
+    Only the most recent builds of each builder and build type are
+    kept, so the estimates follow builds that get quicker or slower.
+    Builds which reused cached results (see LSBBuildCache) aren't
+    counted; the estimates are for a real build."""
+
+    def __init__(self, history=20):
+        self.history = history
+        self.samples = {}
+        self.version = 0
+        self._estimates = {}
+
+    def add(self, builder, build_type, duration):
+        key = (builder, build_type)
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.history)
+        self.samples[key].append(duration)
+        self.version += 1
+        self._estimates = {}
+
+    def add_build(self, row):
+        "Add a build_durations row, if it's one we should count."
+
+        if row["result"] in good_results and not row["cached"]:
+            self.add(row["builder"], row["build_type"], row["duration"])
+
+    def load(self, store, days=90):
+        for row in store.builds(days_ago(days)):
+            self.add_build(row)
+
+    def estimate(self, builder=None, arch=None, build_type=None, q=0.5):
+        """Estimate a build's duration from the builds that match.
+
+        Returns None if there's nothing to go on."""
+
+        key = (builder, arch, build_type, q)
+        if key not in self._estimates:
+            values = []
+            for ((b, t), durations) in self.samples.items():
+                if (builder is None or b == builder) and \
+                   (arch is None or builder_arch(b) == arch) and \
+                   (build_type is None or t == build_type):
+                    values.extend(durations)
+            if values:
+                values.sort()
+                self._estimates[key] = quantile(values, q)
+            else:
+                self._estimates[key] = None
+        return self._estimates[key]
+
+    def median(self, builder=None, arch=None, build_type=None):
+        return self.estimate(builder, arch, build_type, 0.5)
+
+    def p90(self, builder=None, arch=None, build_type=None):
+        return self.estimate(builder, arch, build_type, 0.9)
+
+    def expected(self, builder, build_type=None):
+        """Our best guess at a builder's duration, never None.
+
+        Builders we haven't seen are assumed to take as long as the
+        usual build on their architecture."""
+
+        for estimate in [self.median(builder, build_type=build_type),
+                         self.median(builder),
+                         self.median(arch=builder_arch(builder)),
+                         self.median()]:
+            if estimate is not None:
+                return estimate
+        return default_duration
+
+# The master config is read again on every reconfig, but the build
+# history shouldn't be forgotten, or loaded twice; so there's one
+# estimator for each database for as long as the master runs.
+
+shared_estimators = {}
+
+def shared_estimator(path):
+    if path not in shared_estimators:
+        estimator = DurationEstimator()
+        store = MetricsStore(path)
+        try:
+            estimator.load(store)
+        except sqlite3.Error:
+            pass
+        store.close()
+        shared_estimators[path] = estimator
+    return shared_estimators[path]
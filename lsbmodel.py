@@ -0,0 +1,308 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# The LSB project model: which projects we build, on which
+# architectures, out of which branches, and what they need to build.
+#
+# The tables here used to live in lsb_master.cfg, which worked out
+# everything else from them with nested loops and list scans as it
+# went, for every project and architecture.  Now the master config, and
+# the scripts which need to know about the builds, get them from here.
+# LSBModel works out the indexes the config needs (reverse
+# dependencies, watched branches, builder names) once, when it's
+# created, so the config only ever does dictionary lookups.
+
+import lsbdag
+
+# Supported architectures.
+lsb_archs = ["x86_64", "x86", "ia64", "ppc32", "ppc64", "s390", "s390x"]
+
+# This funny-sounding setting controls which architecture we hold
+# responsible for building architecture-independent components.
+lsb_buildslave_arch_indep_arch = "x86_64"
+
+# Some architectures, for whatever reason, need to use as few resources
+# as possible while still allowing it to be supported.  We don't build
+# these archs on every version control change, and we may limit builds
+# in other ways as well.  Note that the arch independent arch, defined
+# immediately above, CANNOT be part of this list.
+low_resource_archs = []
+
+# Extra projects to build as part of the SDK project.
+lsb_bzr_sdk_projects = ["lsbdev-c++", "lsbdev-qt", "lsbdev-qt3"]
+
+# "Package subdir" projects.  These have a "package" directory off the
+# source root, which has a Makefile which acts a certain way.  See any
+# of the current projects' package/Makefile for an example.  We declare
+# each project here as the key to the dict, and any extra repositories
+# needed during the build in the array value.
+lsb_pkg_subdir_projects = { "app-checker": [],
+                            "azov-qt4-tests": ["t2c-harness"],
+                            "azov-xml2-tests": ["t2c-harness"],
+                            "desktop-test": ["xml-test", "misc-test"],
+                            "distribution-checker": [],
+                            "libstdcpp-test": [],
+                            "lsb-setup": [],
+                            "lsb-xvfb": [],
+                            "lsb-sigchk": [],
+                            "lsbappchk-perl": [],
+                            "lsbappchk-python": ["misc-test"],
+                            "lsbappchk-sh": [],
+                            "makelsbpkg": [],
+                            "misc-test": [],
+                            "olver-core-tests": [],
+                            "perl-test": [],
+                            "printing-test": ["runtime-test"],
+                            "python-test": ["misc-test"],
+                            "qmtest-harness": [],
+                            "runtime-test": [],
+                            "t2c-alsa-tests": ["t2c-harness"],
+                            "t2c-cpp-tests": ["t2c-harness"],
+                            "t2c-desktop-tests": ["t2c-harness"],
+                            "t2c-runtime-tests": ["t2c-harness"],
+                            "task-pkgs": [],
+                            "tet-harness": [],
+                            "xts5-test": ["vsw4-test"] }
+
+# "Packaging" projects.  These are built out of a tree called "packaging".
+# The name of the project in packaging is the first value of each tuple,
+# while the repository used to build it is the second.
+lsb_packaging_projects = []
+
+lsb_arch_indep_projects = ["lsb-setup", "lsbappchk-perl", "lsbappchk-python", 
+                           "lsbappchk-sh", "perl-test", "task-pkgs"]
+
+# Dependencies.  The key is the package being built, and the values are
+# the list of packages which it needs to build.  For example, if you need
+# "foo" to build "bar", you'd do "bar": ["foo"].  Dependencies cannot be
+# recursive, as this could cause builder deadlocks.  Each dependency can
+# be just the name of a project, or a 2-tuple with the name of the project
+# and the packages to actually install in a list; each package name is
+# used in a "<name>*.rpm" search to find the packages.
+lsb_dependencies = { "appbat": ["tet-harness", "libbat",
+                                ("misc-test", ["lsb-appchk"])],
+                     "libstdcpp-test": ["qmtest-harness"],
+                     "azov-qt4-tests": ["tet-harness"],
+                     "azov-xml2-tests": ["tet-harness"],
+                     "desktop-test": ["tet-harness"],
+                     "printing-test": ["tet-harness"],
+                     "runtime-test": ["tet-harness"],
+                     "t2c-alsa-tests": ["tet-harness"],
+                     "t2c-cpp-tests": ["tet-harness"],
+                     "t2c-desktop-tests": ["tet-harness"],
+                     "t2c-runtime-tests": ["tet-harness"],
+                     "xts5-test": ["tet-harness"] }
+
+# Branches we watch, besides devel.
+branch_watch_list = { "4.0": [ "appbat", "azov-qt4-tests",
+                               "desktop-test", "libstdcpp-test", "misc-test",
+                               "olver-core-tests", "perl-test", 
+                               "printing-test", "python-test", "runtime-test",
+                               "t2c-cpp-tests", "t2c-desktop-tests", 
+                               "xml-test", "xts5-test" ],
+                      "4.1": [ "appbat", "desktop-test",
+                               "libstdcpp-test", "misc-test",
+                               "olver-core-tests", "perl-test",
+                               "printing-test", "python-test", "runtime-test", 
+                               "t2c-alsa-tests", "t2c-desktop-tests"] }
+
+
+# The model itself.  It's built from the tables above by default, but
+# takes them as arguments, so that other tables (larger ones, for timing
+# the config) can be tried out.
+
+class LSBModel:
+    def __init__(self, archs=lsb_archs,
+                 indep_arch=lsb_buildslave_arch_indep_arch,
+                 low_resource=low_resource_archs,
+                 sdk_projects=lsb_bzr_sdk_projects,
+                 pkg_subdir_projects=lsb_pkg_subdir_projects,
+                 packaging_projects=lsb_packaging_projects,
+                 indep_projects=lsb_arch_indep_projects,
+                 dependencies=lsb_dependencies,
+                 watch_list=branch_watch_list):
+        self.archs = archs
+        self.indep_arch = indep_arch
+        self.low_resource = set(low_resource)
+        self.sdk_projects = sdk_projects
+        self.pkg_subdir_projects = pkg_subdir_projects
+        self.packaging_projects = packaging_projects
+        self.indep_projects = set(indep_projects)
+        self.dependencies = dependencies
+        self.watch_list = watch_list
+
+        # Branches each project is watched on, besides devel.
+        self.watched_branches = {}
+        for branch in sorted(watch_list.keys()):
+            for project in watch_list[branch]:
+                self.watched_branches.setdefault(project, []).append(branch)
+
+        # Each project's dependencies, as (project, packages) pairs; an
+        # empty package prefix means all of the dependency's packages.
+        self.dependency_entries = {}
+        self.depended_on = set()
+        for (project, deps) in dependencies.items():
+            entries = []
+            for dep_entry in deps:
+                if isinstance(dep_entry, tuple):
+                    entries.append(dep_entry)
+                else:
+                    entries.append((dep_entry, [""]))
+                self.depended_on.add(lsbdag.dependency_name(dep_entry))
+            self.dependency_entries[project] = entries
+
+        self.dag = lsbdag.BuildDAG(dependencies, sdk_projects)
+
+        # Everything built per architecture, in the order the config
+        # has always listed them.
+        self.arch_projects = pkg_subdir_projects.keys() + \
+            ["appbat", "libbat"] + [x[0] for x in packaging_projects]
+
+        self._builder_names = {}
+
+    def build_archs(self, project):
+        "Get the architectures a project is built on."
+
+        if project in self.indep_projects:
+            return [self.indep_arch]
+        return self.archs
+
+    def is_dependency(self, project):
+        "Does any project need this one's results to build?"
+
+        return project in self.depended_on
+
+    def branches_for(self, project):
+        "Get the branches a project is watched on, besides devel."
+
+        return self.watched_branches.get(project, [])
+
+    def always_devel(self, project):
+        "Is this project only ever built from devel?"
+
+        return project not in self.watched_branches
+
+    def pull_from_devel(self, repo):
+        "Is this extra repository always checked out from devel?"
+
+        # For now, just use "branches not specific to 4.0" as the rule
+        # for this.
+        return "4.0" not in self.branches_for(repo)
+
+    def change_sources(self):
+        "Get the repositories whose commits we hear about, once each."
+
+        extra_repos = []
+        for prj in sorted(self.pkg_subdir_projects.keys()):
+            extra_repos.extend(self.pkg_subdir_projects[prj])
+        if self.packaging_projects:
+            extra_repos.append("packaging")
+
+        sources = []
+        seen = set()
+        for project in self.pkg_subdir_projects.keys() + \
+                [x[1] for x in self.packaging_projects if x[1] is not None] + \
+                ["build_env", "appbat", "devchk"] + extra_repos:
+            if project not in seen:
+                seen.add(project)
+                sources.append(project)
+        return sources
+
+    def branch_index(self):
+        """Map each branch to the builders its commits start.
+
+        The index maps a branch to a dict of {target branch: builders}.
+        The target is the branch the builders build: the changed branch
+        itself, or, for changes to an extra repository, the latest of the
+        branch of the project which uses it.  Low-resource architectures
+        are left out; they're scheduled by low-resource-jobs."""
+
+        index = {}
+
+        def add(branch, target, builder):
+            builders = index.setdefault(branch, {}).setdefault(target, [])
+            if builder not in builders:
+                builders.append(builder)
+
+        for prj in sorted(self.pkg_subdir_projects.keys()):
+            for arch in self.build_archs(prj):
+                if arch in self.low_resource:
+                    continue
+                builder = "%s-%s" % (prj, arch)
+                for branch in ["devel"] + self.branches_for(prj):
+                    prj_branch = "lsb/%s/%s" % (branch, prj)
+                    add(prj_branch, prj_branch, builder)
+                    for repo in self.pkg_subdir_projects[prj]:
+                        if self.pull_from_devel(repo):
+                            repo_branch = "lsb/devel/" + repo
+                        else:
+                            repo_branch = "lsb/%s/%s" % (branch, repo)
+                        add(repo_branch, prj_branch, builder)
+
+        for arch in self.archs:
+            if arch not in self.low_resource:
+                for prj in ["libbat", "appbat"]:
+                    add("lsb/devel/appbat", "lsb/devel/appbat",
+                        "%s-%s" % (prj, arch))
+
+        for (prj, repo) in self.packaging_projects:
+            if prj in self.indep_projects:
+                archs = [self.indep_arch]
+            else:
+                archs = [x for x in self.archs if x not in self.low_resource]
+            if repo is not None:
+                target = "lsb/devel/" + repo
+            else:
+                target = "lsb/devel/packaging"
+            for arch in archs:
+                builder = "%s-%s" % (prj, arch)
+                add("lsb/devel/packaging", target, builder)
+                add(target, target, builder)
+
+        return index
+
+    def consumer_index(self):
+        """Map each producer build to the consumer builds to redo.
+
+        Keys are (producer builder, branch name); values are dicts of
+        {target branch: consumer builders}, as for branch_index.  A
+        consumer on a branch installs the producer's saved results from
+        the same branch, or from devel if the producer is only ever
+        built from devel.  The SDK isn't included; rebuilding everything
+        after every SDK build would defeat the point."""
+
+        index = {}
+        for (project, entries) in self.dependency_entries.items():
+            for (dep, dep_pkg_list) in entries:
+                if dep in self.sdk_projects:
+                    continue
+                for arch in self.build_archs(project):
+                    if arch in self.low_resource:
+                        continue
+                    producer = "%s-%s" % (dep, arch)
+                    consumer = "%s-%s" % (project, arch)
+                    for branch in ["devel"] + self.branches_for(project):
+                        if self.always_devel(dep) and dep != "libbat":
+                            dep_branch = "devel"
+                        else:
+                            dep_branch = branch
+                        targets = index.setdefault((producer, dep_branch), {})
+                        builders = targets.setdefault(
+                            "lsb/%s/%s" % (branch, project), [])
+                        if consumer not in builders:
+                            builders.append(consumer)
+        return index
+
+    def builder_names(self, devchk_slaves=[]):
+        "List every builder, for the schedulers that can run any of them."
+
+        key = tuple(devchk_slaves)
+        if key not in self._builder_names:
+            names = ["build-sdk-" + x for x in self.archs]
+            for project in self.arch_projects:
+                for arch in self.build_archs(project):
+                    names.append("%s-%s" % (project, arch))
+            for devchk_job in ["devchk", "build-sdk"]:
+                names.extend([devchk_job + "-" + x for x in devchk_slaves])
+            self._builder_names[key] = names
+        return self._builder_names[key]
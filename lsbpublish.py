@@ -0,0 +1,303 @@
+# Helpers for publishing build results from the master's upload area.
+#
+# The builders upload one results tarball per project, branch and
+# architecture to the master.  Publishing them used to mean deleting
+# the published directories and unpacking every tarball again, one at a
+# time, whenever anything changed.  Instead, we keep a manifest of what
+# each tarball contributed the last time we published it.  Only the
+# tarballs that have changed get read again, and their members are
+# streamed straight to where they belong; files from unchanged tarballs
+# are hard-linked over from the current directory.  Each published
+# directory is rebuilt off to the side and swapped in whole, so nobody
+# (rsync included) ever sees one half-written.
+#
+# The work is split into jobs, one per group of directories fed by the
+# same tarballs, and the jobs are run in a process pool.
+
+import os
+import errno
+import json
+import shutil
+import tarfile
+import subprocess
+import multiprocessing
+
+# Results tarballs may be compressed with gzip or zstd; see the
+# artifact_format setting in the master config.
+tarball_suffixes = (".tar.gz", ".tar.zst")
+
+def strip_tarball_suffix(name):
+    "Strip a results tarball suffix; returns None if there isn't one."
+
+    for suffix in tarball_suffixes:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return None
+
+def open_tarball(path):
+    "Open a tarball for streaming; returns the tarfile and any helper."
+
+    if path.endswith(".tar.zst"):
+        p = subprocess.Popen(["zstd", "-d", "-c", "-q", path],
+                             stdout=subprocess.PIPE)
+        return (tarfile.open(fileobj=p.stdout, mode="r|"), p)
+    return (tarfile.open(path, "r|*"), None)
+
+def tarball_stamp(path):
+    st = os.stat(path)
+    return [int(st.st_mtime), st.st_size]
+
+def member_path(name):
+    "Normalize a tarball member name; our tarballs are made from '..'."
+
+    return "/".join([p for p in name.split("/") if p not in ("", ".", "..")])
+
+# Filters decide which members of a results tarball get published, and
+# where.  They're given (results directory, destination) routes; the
+# destination is relative to the job's base directory.  These have to
+# be picklable, so they can be handed to the worker processes.
+
+class ResultsFilter:
+    def __init__(self, routes, packages_only=True, include_src=True,
+                 recursive=False, flatten=True):
+        self.routes = routes
+        self.packages_only = packages_only
+        self.include_src = include_src
+        self.recursive = recursive
+        self.flatten = flatten
+
+    def __call__(self, name):
+        name = member_path(name)
+        for (results_dir, dest) in self.routes:
+            if not name.startswith(results_dir + "/"):
+                continue
+            rel = name[len(results_dir) + 1:]
+            base = os.path.basename(rel)
+            if "/" in rel and not self.recursive:
+                return None
+            if self.packages_only and not base.endswith(".rpm"):
+                return None
+            if base.endswith("src.rpm") and not self.include_src:
+                return None
+            if self.flatten:
+                rel = base
+            return dest + "/" + rel
+        return None
+
+class PublishJob:
+    def __init__(self, name, base, outputs, sources):
+        self.name = name
+        self.base = base
+        self.outputs = outputs
+        self.sources = sorted(sources)
+        self.previous = {}
+
+    def source_names(self):
+        return sorted([os.path.basename(t) for (t, f) in self.sources])
+
+    def needs_publish(self):
+        "Check the job against what we published last time."
+
+        if sorted(self.previous.keys()) != self.source_names():
+            return True
+        for output in self.outputs:
+            if not os.path.isdir(os.path.join(self.base, output)):
+                return True
+        for (tarball, member_filter) in self.sources:
+            entry = self.previous[os.path.basename(tarball)]
+            if entry["stamp"] != tarball_stamp(tarball):
+                return True
+        return False
+
+    def new_dir(self, output):
+        (head, tail) = os.path.split(os.path.join(self.base, output))
+        return os.path.join(head, "." + tail + ".new")
+
+    def new_path(self, rel):
+        "Map a published file to its place in the directory being built."
+
+        for output in self.outputs:
+            if rel.startswith(output + "/"):
+                return os.path.join(self.new_dir(output),
+                                    rel[len(output) + 1:])
+        return None
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        if os.path.exists(path):
+            try:
+                self.jobs = json.load(open(path))
+            except ValueError:
+                # Losing the manifest just means publishing everything.
+                self.jobs = {}
+
+    def save(self):
+        f = open(self.path + ".tmp", "w")
+        try:
+            json.dump(self.jobs, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(self.path + ".tmp", self.path)
+
+def make_parent(path):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+def clear_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+def link_file(src, dest):
+    make_parent(dest)
+    clear_path(dest)
+    try:
+        os.link(src, dest)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+        shutil.copy2(src, dest)
+
+def extract_members(tarball, member_filter, dest_for):
+    """Stream the wanted members of a tarball to their destinations.
+
+    Returns the published paths (relative to the job's base) of the
+    files written."""
+
+    written = []
+    (t, helper) = open_tarball(tarball)
+    try:
+        for member in t:
+            if not member.isfile():
+                continue
+            rel = member_filter(member.name)
+            if rel is None:
+                continue
+            dest = dest_for(rel)
+            if dest is None:
+                continue
+
+            make_parent(dest)
+            clear_path(dest)
+            src = t.extractfile(member)
+            out = open(dest, "wb")
+            try:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+            finally:
+                out.close()
+            os.chmod(dest, 0644)
+
+            # Keep the build's timestamps, so that rsync can tell that a
+            # package it has already copied hasn't changed.
+            os.utime(dest, (member.mtime, member.mtime))
+            written.append(rel)
+    finally:
+        t.close()
+        if helper:
+            helper.stdout.close()
+            if helper.wait() != 0:
+                raise IOError("zstd failed on %s" % tarball)
+    return written
+
+def swap_dir(new_path, path):
+    "Replace a directory with a new version of it."
+
+    old_path = os.path.join(os.path.dirname(path),
+                            "." + os.path.basename(path) + ".old")
+    clear_path(old_path)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(new_path, path)
+    clear_path(old_path)
+
+def publish_job(job):
+    "Rebuild a job's directories; returns its new manifest entry."
+
+    for output in job.outputs:
+        clear_path(job.new_dir(output))
+        os.makedirs(job.new_dir(output))
+
+    entry = {}
+    for (tarball, member_filter) in job.sources:
+        name = os.path.basename(tarball)
+        stamp = tarball_stamp(tarball)
+        previous = job.previous.get(name)
+
+        files = None
+        if previous and previous["stamp"] == stamp:
+            files = previous["files"]
+            for rel in files:
+                if not os.path.isfile(os.path.join(job.base, rel)):
+                    files = None
+                    break
+        if files is not None:
+            for rel in files:
+                link_file(os.path.join(job.base, rel), job.new_path(rel))
+            print "%s: %s unchanged" % (job.name, name)
+        else:
+            files = extract_members(tarball, member_filter, job.new_path)
+            print "%s: unpacked %d files from %s" \
+                % (job.name, len(files), name)
+
+        entry[name] = {"stamp": stamp, "files": files}
+
+    for output in job.outputs:
+        swap_dir(job.new_dir(output), os.path.join(job.base, output))
+
+    return entry
+
+def _run_job(job):
+    "Pool wrapper, so that one bad tarball doesn't sink the others."
+
+    try:
+        return (job.name, publish_job(job), None)
+    except Exception, e:
+        return (job.name, None, "%s: %s" % (e.__class__.__name__, e))
+
+def publish(jobs, manifest_path, processes=None):
+    """Publish whatever has changed in a list of jobs.
+
+    Returns the names of the jobs that failed."""
+
+    manifest = Manifest(manifest_path)
+    names = set([job.name for job in jobs])
+    for name in manifest.jobs.keys():
+        if name not in names:
+            del manifest.jobs[name]
+
+    pending = []
+    for job in jobs:
+        job.previous = manifest.jobs.get(job.name, {})
+        if job.needs_publish():
+            pending.append(job)
+
+    failed = []
+    if not pending:
+        manifest.save()
+        return failed
+
+    if processes == 1 or len(pending) == 1:
+        results = map(_run_job, pending)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_run_job, pending, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    for (name, entry, error) in results:
+        if error:
+            print "%s: failed: %s" % (name, error)
+            failed.append(name)
+            if name in manifest.jobs:
+                del manifest.jobs[name]
+        else:
+            manifest.jobs[name] = entry
+
+    manifest.save()
+    return failed
@@ -1,4 +1,17 @@
-var timers = new Object();
+// The status table is built from one JSON document on the master
+// ("matrix"; see StatusMatrix in lfbuildbot.py), which covers every
+// builder.  We keep one long-poll request outstanding for it: the
+// master answers as soon as the table changes, or with a bodyless 304
+// once the wait is up.  In between, the table is redrawn every so often
+// from what we have, so the times stay current.
+
+var matrix_url = "matrix";
+var matrix_wait = 60;
+var retry_interval = 15000;
+var redraw_interval = 60000;
+
+var matrix = null;
+var matrix_etag = null;
 
 function get_timediff_description(start, end) {
     var timediff = Math.floor(end - start);
@@ -27,162 +40,118 @@ function get_timediff_description(start, end) {
     return timedesc;
 }
 
-function load_slaveinfo(data) {
-    var items = "";
-    var load_interval = 0.1;
-    for (var item in data) {
-        if (item.substr(0, 7) == "lfbuild") {
-            var arch = item.substr(8);
-            var connecttype;
-            if (!data[item]["connected"]) {
-                connecttype = "offline";
-            } else if (data[item]["runningBuilds"].length > 0) {
-                connecttype = "running";
-                var buildItem = data[item]["runningBuilds"][0];
-                set_builder_refresh(buildItem["builderName"],
-                                    load_interval * 1000);
-                load_interval = load_interval + 0.1;
-            } else {
-                connecttype = "idle";
-            }
-	    $("#heading-" + arch).html(arch + "<br />" + connecttype).attr("class", connecttype);
-        }
+function get_eta_description(build, now) {
+    if (build["expected"] == null) {
+        return "";
+    }
+    var remaining = Math.round((build["times"][0] + build["expected"] - now)
+                               / 60);
+    if (remaining > 1) {
+        return "<br />about " + remaining + " minutes left";
+    } else {
+        return "<br />due about now";
     }
 }
 
-function load_new_data() {
-    $.ajax({
-        url: "json/slaves/",
-        success: function(data) {
-            load_slaveinfo(data);
-        }
-    });
+function builder_cell(builder, build, now) {
+    var status_desc;
+    var status_class;
+    if (build == null) {
+        status_desc = "no builds";
+        status_class = "none";
+    } else if (!("results" in build)) {
+        status_desc = "<a href='builders/" + builder
+            + "/builds/" + build["number"] + "'>"
+            + build["step"] + "</a>" + get_eta_description(build, now);
+        status_class = "running";
+    } else if (build["results"] == 0) {
+        status_desc = "<a href='builders/" + builder
+            + "'>" + get_timediff_description(build["times"][1], now)
+            + "</a>";
+        status_class = "success";
+    } else if (build["results"] == 2) {
+        status_desc = "<a href='builders/" + builder
+            + "/builds/" + build["number"] + "'>"
+            + build["text"].join(" ") + "</a>";
+        status_class = "failure";
+    } else {
+        status_desc = "unknown: " + build["results"];
+        status_class = "none";
+    }
+    return "    <td id='" + builder + "' class='" + status_class + "'>"
+        + status_desc + "</td>\n";
 }
 
 function create_status_table(data) {
-    var archs = new Array();
-    var projects = new Object();
-    var load_interval = 0.1;
-    for (var item in data) {
-        if (item.substr(0, 7) == "lfbuild") {
-            var arch = item.substr(8);
-            archs.push(arch);
-
-            for (var builder in data[item]["builders"]) {
-                var project = builder.substr(0, builder.lastIndexOf("-"));
-                if (!(project in projects)) {
-                    projects[project] = new Object();
-                }
-                projects[project][arch] = "unknown";
-            }
-        }
+    var now = new Date().getTime() / 1000;
+    var archs = data["archs"];
+    var projects = new Array();
+    for (var project in data["projects"]) {
+        projects.push(project);
     }
+    projects.sort();
+
     var status_table = "<table>\n  <tr>\n    <th></th>\n";
     archs.forEach(function(arch) {
-        status_table += "    <th id='heading-" + arch + "'>" + arch
-	    + "<br />unknown</th>\n";
+        var connecttype = data["slaves"][arch] || "unknown";
+        status_table += "    <th id='heading-" + arch + "' class='"
+            + connecttype + "'>" + arch + "<br />" + connecttype
+            + "</th>\n";
     });
     status_table += "  </tr>\n";
-    for (var project in projects) {
+    projects.forEach(function(project) {
+        var builds = data["projects"][project];
         status_table += " <tr>\n    <th>" + project + "</th>\n";
         archs.forEach(function(arch) {
-            var arch_item;
-            var builder = project + "-" + arch;
-            if (arch in projects[project]) {
-                arch_item = projects[project][arch];
-                set_builder_refresh(builder, load_interval * 1000);
-                load_interval = load_interval + 0.1;
+            if (arch in builds) {
+                status_table += builder_cell(project + "-" + arch,
+                                             builds[arch], now);
             } else {
-                arch_item = "&nbsp;";
+                status_table += "    <td>&nbsp;</td>\n";
             }
-            status_table += "    <td id='" + builder + "'>" 
-                + arch_item + "</td>\n";
         });
         status_table += " </tr>\n";
-    }
+    });
     status_table += "</table>\n";
     $("#status_table").html(status_table);
 }
 
-function set_builder_refresh(builder, interval) {
-    var currentTime = new Date().getTime();
-    var setNewTimer = false;
-
-    if (timers.hasOwnProperty(builder)) {
-        var timeoutHandle = timers[builder][0];
-        var timeoutFireTime = timers[builder][1];
-        if ((currentTime > timeoutFireTime) || 
-            ((currentTime + interval) < timeoutFireTime)) {
-            window.clearTimeout(timeoutHandle);
-            setNewTimer = true;
-        }
-    } else {
-        setNewTimer = true;
-    }
-
-    if (setNewTimer) {
-        timers[builder] = [window.setTimeout(update_builder_status, interval,
-                                             [builder]),
-                           currentTime + interval];
+function redraw_status_table() {
+    if (matrix != null) {
+        create_status_table(matrix);
     }
 }
 
-function update_builder_status(builder) {
+function load_matrix() {
+    var headers = new Object();
+    var url = matrix_url;
+    if (matrix_etag != null) {
+        headers["If-None-Match"] = matrix_etag;
+        url += "?wait=" + matrix_wait;
+    }
     $.ajax({
-            url: "json/builders/" + builder + "/builds/-1",
-            success: function(data) {
-                var status_desc;
-                var status_class;
-                if (data["currentStep"] != null) {
-                    var step_name = data["currentStep"]["name"];
-                    status_desc = "<a href='builders/" + builder
-                        + "/builds/" + data["number"] + "'>"
-                        + step_name + "</a>";
-                    status_class = "running";
-                    set_builder_refresh(builder, 15000);
-                } else if (data["results"] == 0) {
-                    var build_end = data["times"][1];
-                    var now = new Date().getTime() / 1000;
-                    var timediff_desc = 
-                        get_timediff_description(build_end, now);
-                    status_desc = "<a href='builders/" + builder
-                        + "'>" + timediff_desc + "</a>";
-                    status_class = "success";
-                    var timediff = now - build_end;
-                    var nextrun;
-                    if (timediff < 300) {
-                        nextrun = 1;
-                    } else if ((timediff >= 300) && (timediff < 3600)) {
-                        nextrun = 5;
-                    } else {
-                        nextrun = 30;
-                    }
-                    set_builder_refresh(builder, nextrun * 60000);
-                } else if (data["results"] == 2) {
-                    status_desc = "<a href='builders/" + builder
-                        + "/builds/" + data["number"] + "'>"
-                        + data["text"].join(" ") + "</a>";
-                    status_class = "failure";
-                } else {
-                    status_desc = "unknown: " + data["results"];
-                    status_class = "none";
-                }
-                $("#" + builder).html(status_desc).attr('class', status_class);
-            },
-            error: function() {
-                $("#" + builder).html("error getting status").attr('class', 'none');
-                set_builder_refresh(builder, 15000);
-            },
-        });
+        url: url,
+        headers: headers,
+        dataType: "json",
+        success: function(data, textStatus, xhr) {
+            if (xhr.status != 304 && data) {
+                matrix = data;
+                matrix_etag = xhr.getResponseHeader("ETag");
+                create_status_table(matrix);
+            }
+            load_matrix();
+        },
+        error: function() {
+            if (matrix == null) {
+                $("#status_table").html("error getting status");
+            }
+            matrix_etag = null;
+            window.setTimeout(load_matrix, retry_interval);
+        }
+    });
 }
 
 $(document).ready(function(data) {
-        $.ajax({
-                url: "json/slaves/",
-                success: function(data) {
-                    create_status_table(data);
-                    load_slaveinfo(data);
-                    window.setInterval(load_new_data, 15000);
-                }
-            });
+        load_matrix();
+        window.setInterval(redraw_status_table, redraw_interval);
     });
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+# Tests for lfbuildbot.py.  These need buildbot installed, like the
+# master itself.
+#
+# Run with "trial test_lfbuildbot".
+
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+import lfbuildbot
+
+branch_map = { "lsb/devel/misc-test": "misc-test",
+               "lsb/devel/runtime-test": "runtime-test" }
+
+class FakeMaster:
+    def __init__(self):
+        self.changes = []
+
+    def addChange(self, **kwargs):
+        self.changes.append(kwargs)
+        return defer.succeed(None)
+
+class TestMaildirSource(lfbuildbot.BzrLsbMaildirSource):
+    """Stands in for the Launchpad mail parser, which isn't what's being
+    tested here; messages marked as broken make it fail."""
+
+    def parse(self, m, prefix=None):
+        match = lfbuildbot.lsb_subject_re.search(m['subject'].strip())
+        if "broken" in m['subject']:
+            raise ValueError("can't parse " + m['subject'])
+        return ("bzr", { 'branch': self.branchMap[match.group(1)],
+                         'revision': match.group(2),
+                         'repository': match.group(1),
+                         'files': [], 'comments': m['subject'] })
+
+class MaildirSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.maildir = tempfile.mkdtemp(prefix="test_lfbuildbot.")
+        for subdir in ("new", "cur", "tmp"):
+            os.mkdir(os.path.join(self.maildir, subdir))
+        self.source = TestMaildirSource(self.maildir, branchMap=branch_map)
+        self.source.master = FakeMaster()
+
+    def tearDown(self):
+        self.source.stopService()
+        shutil.rmtree(self.maildir)
+
+    def deliver(self, filename, branch, revno, subject="fix things"):
+        f = open(os.path.join(self.maildir, "new", filename), "w")
+        f.write("Subject: [Lsb-messages] %s r%d: %s\n"
+                "Message-Id: <%s@example.com>\n"
+                "\n"
+                "revno: %d\n" % (branch, revno, subject, filename, revno))
+        f.close()
+        self.source.messageReceived(filename)
+
+    def test_bad_message_keeps_batch(self):
+        self.deliver("1", "lsb/devel/misc-test", 10)
+        self.deliver("2", "lsb/devel/runtime-test", 20, "broken")
+        self.deliver("3", "lsb/devel/runtime-test", 21)
+        self.deliver("4", "lsb/devel/misc-test", 11)
+
+        # Flush now, rather than waiting for the coalescing delay.
+        self.source.flusher.cancel()
+        d = self.source.flush()
+
+        def check(result):
+            self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+            changes = self.source.master.changes
+            self.assertEqual([(c['branch'], c['revision']) for c in changes],
+                             [("misc-test", "11"), ("runtime-test", "21")])
+            self.assertEqual(sorted(os.listdir(os.path.join(self.maildir,
+                                                            "cur"))),
+                             ["1", "2", "3", "4"])
+        d.addCallback(check)
+        return d
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+
+# Tests for lsbjson.py, against a stand-in for buildbot's JSON status
+# interface running on a local port.
+#
+# Run with "python test_lsbjson.py".
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import lsbjson
+
+# The stand-in is on localhost; don't send requests for it to a proxy.
+for var in ("http_proxy", "HTTP_PROXY"):
+    os.environ.pop(var, None)
+
+# What the stand-in serves: two builders with a couple of builds each.
+def make_status():
+    status = { "builders": {} }
+    for name in ("lsb-sdk-x86", "lsb-sdk-x86_64"):
+        status["builders"][name] = { "builds": {} }
+        for n in (1, 2):
+            status["builders"][name]["builds"]["-%d" % n] = \
+                { "builderName": name, "number": 10 - n,
+                  "times": [1000.0 - n, 2000.0 - n] }
+    return status
+
+def lookup(status, path):
+    node = status
+    for element in path.strip("/").split("/"):
+        if not isinstance(node, dict) or element not in node:
+            return None
+        node = node[element]
+    return node
+
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.enter(self)
+        try:
+            self.respond()
+        finally:
+            server.leave()
+
+    def respond(self):
+        server = self.server
+        (path, query) = urlparse.urlsplit(self.path)[2:4]
+        path = path[len("/json"):].strip("/")
+        selected = urlparse.parse_qs(query).get("select", [])
+
+        if selected:
+            if not server.select_supported:
+                self.send_error(400, "select not supported")
+                return
+            data = {}
+            for p in selected:
+                node = lookup(server.status, p)
+                if node is None:
+                    self.send_error(404, "no such resource: " + p)
+                    return
+                parent = data
+                elements = p.strip("/").split("/")
+                for element in elements[:-1]:
+                    parent = parent.setdefault(element, {})
+                parent[elements[-1]] = node
+        else:
+            data = lookup(server.status, path)
+            if data is None:
+                self.send_error(404, "no such resource: " + path)
+                return
+
+        etag = '"%d"' % server.version
+        if self.headers.getheader("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+class StatusServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           StatusHandler)
+        self.status = make_status()
+        self.version = 1
+        self.select_supported = True
+        # Each request is held up a little, so requests made at the same
+        # time overlap and can be counted.
+        self.delay = 0.1
+        self.lock = threading.Lock()
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def enter(self, handler):
+        self.lock.acquire()
+        try:
+            self.requests.append((handler.path,
+                                  handler.headers.getheader("If-None-Match")))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        finally:
+            self.lock.release()
+        time.sleep(self.delay)
+
+    def leave(self):
+        self.lock.acquire()
+        try:
+            self.in_flight -= 1
+        finally:
+            self.lock.release()
+
+    def change(self):
+        "Change the status, as a finished build would."
+
+        self.status["builders"]["lsb-sdk-x86"]["builds"]["-1"]["number"] += 1
+        self.version += 1
+
+class BuildbotJSONTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StatusServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/json" % self.server.server_address[1]
+        self.cache_dir = tempfile.mkdtemp(prefix="test_lsbjson.")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def client(self, **kwargs):
+        return lsbjson.BuildbotJSON(self.url, **kwargs)
+
+    def build_paths(self):
+        return ["builders/%s/builds/-%d" % (name, n)
+                for name in ("lsb-sdk-x86", "lsb-sdk-x86_64")
+                for n in (1, 2)]
+
+    def expire(self, client, url):
+        "Make a cache entry old enough that the TTL is up."
+
+        path = client._cache_path(url)
+        entry = json.load(open(path))
+        entry["fetched"] -= client.ttl + 1
+        json.dump(entry, open(path, "w"))
+
+    def test_select_batches(self):
+        client = self.client(batch_size=3)
+        results = client.select(self.build_paths())
+
+        # Four paths in batches of three is two requests.
+        self.assertEqual(len(self.server.requests), 2)
+        for (path, etag) in self.server.requests:
+            self.assert_("select=" in path)
+        self.assertEqual(sorted(results.keys()), sorted(self.build_paths()))
+        for path in self.build_paths():
+            self.assertEqual(results[path],
+                             lookup(self.server.status, path))
+
+    def test_recent_builds(self):
+        builds = self.client().recent_builds(["lsb-sdk-x86",
+                                              "lsb-sdk-x86_64"], count=2)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual([b["number"] for b in builds["lsb-sdk-x86"]], [9, 8])
+
+    def test_select_unsupported_falls_back(self):
+        self.server.select_supported = False
+        client = self.client(threads=4)
+        results = client.select(self.build_paths())
+
+        # The failed batch, then one request per path, made concurrently.
+        self.assertEqual(len(self.server.requests), 1 + len(self.build_paths()))
+        self.assert_("select=" in self.server.requests[0][0])
+        self.assert_(self.server.max_in_flight > 1)
+        for path in self.build_paths():
+            self.assertEqual(results[path],
+                             lookup(self.server.status, path))
+
+    def test_fallback_missing_path(self):
+        client = self.client()
+        paths = self.build_paths() + ["builders/lsb-missing-x86/builds/-1"]
+        results = client.select(paths)
+        self.assertEqual(results["builders/lsb-missing-x86/builds/-1"], None)
+        self.assertEqual(results[paths[0]],
+                         lookup(self.server.status, paths[0]))
+
+    def test_cache_ttl(self):
+        client = self.client(cache_dir=self.cache_dir, ttl=300)
+        url = self.url + "/builders/lsb-sdk-x86"
+        first = client.fetch(url)
+        self.assertEqual(client.fetch(url), first)
+        self.assertEqual(len(self.server.requests), 1)
+
+        # Another client sharing the cache (the next cron run) uses it too.
+        again = self.client(cache_dir=self.cache_dir, ttl=300)
+        self.assertEqual(again.fetch(url), first)
+        self.assertEqual(len(self.server.requests), 1)
+
+        self.expire(client, url)
+        client.fetch(url)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_no_cache(self):
+        client = self.client(ttl=300)
+        url = self.url + "/builders/lsb-sdk-x86"
+        client.fetch(url)
+        client.fetch(url)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_etag_revalidation(self):
+        client = self.client(cache_dir=self.cache_dir, ttl=300)
+        url = self.url + "/builders/lsb-sdk-x86/builds/-1"
+        first = client.fetch(url)
+        self.assertEqual(self.server.requests[-1][1], None)
+
+        # Unchanged: the stale entry is revalidated, and the 304 answer
+        # makes it fresh again.
+        self.expire(client, url)
+        self.assertEqual(client.fetch(url), first)
+        self.assertEqual(self.server.requests[-1][1], '"1"')
+        self.assertEqual(client.fetch(url), first)
+        self.assertEqual(len(self.server.requests), 2)
+
+        # Changed: the new data replaces the cache entry.
+        self.server.change()
+        self.expire(client, url)
+        second = client.fetch(url)
+        self.assertEqual(self.server.requests[-1][1], '"1"')
+        self.assertEqual(second["number"], first["number"] + 1)
+        entry = json.load(open(client._cache_path(url)))
+        self.assertEqual(entry["etag"], '"2"')
+        self.assertEqual(entry["data"], second)
+
+if __name__ == "__main__":
+    unittest.main()